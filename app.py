@@ -1,43 +1,145 @@
 import os
+import hmac
+import logging
+import time
 from dotenv import load_dotenv
-import pymongo
 import datetime
 from bson.objectid import ObjectId
-from flask import Flask, request, render_template, redirect, url_for, session, flash
+from flask import Flask, request, render_template, redirect, url_for, session, flash, g, Response, stream_with_context, jsonify
 from flask_login import LoginManager, UserMixin, current_user, login_user, logout_user, login_required
 import bcrypt
+from werkzeug.urls import url_parse
 from functools import wraps
-
-app = Flask(__name__)
-app.config['SECRET_KEY'] =   os.getenv('SECRET_KEY')
+from repository import Repository, update_fields, form_version, exists
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import stats
+from indexes import ensure_indexes
+from caching import TTLCache, ReferenceData
+from passwords import hash_password, check_password, needs_rehash, PasswordsBusy
+from conditional import bump_version, collection_version, page_etag, is_not_modified, not_modified, with_validators
+from metrics import registry, request_seconds, CallbackMetric, SamplingFilter
+from database import LazyClient, LazyDatabase, client_options, public_read_preference, derived_write_concern
+from normalize import normalize_activity, format_cost, format_date
+from geocode import geocode_activity, request_point, radius_km
+from pagination import SORT_DESC
+from export import FORMATS, export_chunks, export_cursor, export_filename, export_format
+from templating import bytecode_cache, precompile_templates, stream_template
+from autocomplete import PrefixIndex
+from livefeed import ChangeFeed, sse_lines
+from jobs import JobRunner
+from related import RelatedIndex
+import cascades
+import bulk
 
 ## necessary for python-dotenv ##
 APP_ROOT = os.path.join(os.path.dirname(__file__), '..')   # refers to application_top
 dotenv_path = os.path.join(APP_ROOT, '.env')
 load_dotenv(dotenv_path)
 
-mongo =   os.getenv('MONGO')
+app = Flask(__name__)
+app.config['SECRET_KEY'] =   os.getenv('SECRET_KEY')
 
+log = logging.getLogger('bucket_list')
+log.setLevel(os.getenv('LOG_LEVEL', 'WARNING'))
+# without a handler of its own, records below WARNING would be dropped by logging's last resort
+if not log.handlers:
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(process)d] %(message)s'))
+    log.addHandler(log_handler)
+# the per-request records go through a child logger, and only a sample of its debug and info records are kept
+request_log = logging.getLogger('bucket_list.requests')
+request_log.addFilter(SamplingFilter(float(os.getenv('LOG_SAMPLE_RATE', 0.01))))
 
-client = pymongo.MongoClient(mongo)
+# compiled templates are kept on disk and shared by every worker on the machine
+app.jinja_options = dict(Flask.jinja_options, bytecode_cache=bytecode_cache(os.getenv('JINJA_CACHE_DIR')))
 
-db = client['bucket_list'] # Mongo collection
-users = db['users'] # Mongo document
-roles = db['roles'] # Mongo document
-categories = db['categories'] # Mongo document
-bucketList = db['bucketList'] # Mongo document
-status = db['status']
+mongo =   os.getenv('MONGO')
+
+
+# the client connects on first use in each worker process, see database.py
+client = LazyClient(mongo, **client_options())
+
+db = LazyDatabase(client, os.getenv('MONGO_DB', 'bucket_list')) # Mongo collection
+public_reads = public_read_preference() # None unless MONGO_PUBLIC_READ_PREFERENCE is set
+repo = Repository(db, public_reads)
+users = repo.users # Mongo document
+roles = repo.roles # Mongo document
+categories = repo.categories # Mongo document
+bucketList = repo.bucketList # Mongo document
+status = repo.status
+counters = db['counters'] # change counters behind the listing ETags
+# the public pages read their change counter the same way they read their rows
+public_counters = counters.with_options(read_preference=public_reads) if public_reads else counters
+activity_stats = db['stats'].with_options(write_concern=derived_write_concern()) # rollups maintained by stats.py
+user_summaries = users.with_options(write_concern=derived_write_concern()) # the summary on each user record
+
+# categories, share statuses and roles, reloaded whenever the admin routes change them
+reference_data = ReferenceData({'categories': categories, 'status': status, 'roles': roles},
+                               max_age=float(os.getenv('REFERENCE_DATA_TTL', 300)))
+
+# search-as-you-type suggestions, kept in memory and updated by this process's writes
+autocomplete_index = PrefixIndex()
+AUTOCOMPLETE_CHECK_SECONDS = float(os.getenv('AUTOCOMPLETE_CHECK_SECONDS', 5))
+AUTOCOMPLETE_REBUILD_SECONDS = float(os.getenv('AUTOCOMPLETE_REBUILD_SECONDS', 30))
+
+# related activities for the print page, refreshed as activities are saved using
+# the model from the last `related.py rebuild`
+related_index = RelatedIndex(bucketList, db['related'].with_options(write_concern=derived_write_concern()))
+
+# category and user cascades run as background jobs, one worker thread per process
+job_runner = JobRunner(db['jobs'], cascades.handlers(bucketList, activity_stats, counters),
+                       stale_seconds=float(os.getenv('JOB_STALE_SECONDS', 60)))
+
+# one change stream per process behind every open /activities/live connection. Under
+# WSGI each connection holds a worker thread, so the list only opens one when
+# LIVE_UPDATES=1 (asgi.py turns it on), and it is closed after LIVE_MAX_SECONDS
+live_feed = ChangeFeed(repo.public)
+app.config['LIVE_UPDATES'] = os.getenv('LIVE_UPDATES') == '1'
+LIVE_MAX_SECONDS = float(os.getenv('LIVE_MAX_SECONDS', 60))
+
+@app.context_processor
+def inject_reference_version():
+    return {'reference_version': reference_data.version}
+
+# estimated_cost is stored in cents and expected_date as a datetime
+app.add_template_filter(format_cost, 'cost')
+app.add_template_filter(format_date, 'day')
+# compile every template now rather than on each page's first request
+precompile_templates(app.jinja_env)
+
+@app.before_first_request
+def create_indexes():
+    ensure_indexes(db)
+
+@app.before_first_request
+def start_job_runner():
+    # also picks up jobs left running by a process that has since stopped
+    job_runner.start()
 
 login = LoginManager()
 login.init_app(app)
 login.login_view = 'login'
 
+# User objects rebuilt by load_user, keyed by username
+user_cache = TTLCache(maxsize=int(os.getenv('USER_CACHE_SIZE', 1024)),
+                      ttl=float(os.getenv('USER_CACHE_TTL', 60)))
+
 @login.user_loader
 def load_user(username):
-    u = users.find_one({"username": username})
+    cached = user_cache.get(username)
+    if cached:
+        return cached
+    u = repo.get_user(username)
     if not u:
         return None
-    return User(username=u['username'], role=u['role'], id=u['_id'])
+    user = User(username=u['username'], role=u['role'], id=u['_id'])
+    user_cache.set(username, user)
+    return user
+
+def invalidate_user(user_id):
+    # the username may be about to change, so match cached users on _id
+    user_cache.pop_matching(lambda user: user._id == user_id)
 
 class User:
     def __init__(self, id, username, role):
@@ -72,25 +174,75 @@ def roles_required(*role_names):
         @wraps(original_route)
         def decorated_route(*args, **kwargs):
             if not current_user.is_authenticated:
-                print('The user is not authenticated.')
+                request_log.info('The user is not authenticated.')
                 return redirect(url_for('login'))
             
-            print(current_user.role)
-            print(role_names)
             if not current_user.role in role_names:
-                print('The user does not have this role.')
+                request_log.info('The user %s with role %s does not have one of the roles %s.',
+                                 current_user.username, current_user.role, role_names)
                 return redirect(url_for('login'))
             else:
-                print('The user is in this role.')
+                request_log.debug('The user %s is in role %s.', current_user.username, current_user.role)
                 return original_route(*args, **kwargs)
         return decorated_route
     return decorator
 
 
+##########  metrics ##########
+registry.add(CallbackMetric('bucket_list_user_cache_hits_total', 'load_user cache hits.', 'counter',
+                            lambda: user_cache.hits))
+registry.add(CallbackMetric('bucket_list_user_cache_misses_total', 'load_user cache misses.', 'counter',
+                            lambda: user_cache.misses))
+registry.add(CallbackMetric('bucket_list_live_subscribers', 'Open /activities/live connections.', 'gauge',
+                            lambda: len(live_feed.subscribers)))
+registry.add(CallbackMetric('bucket_list_autocomplete_entries', 'Entries in the autocomplete index.', 'gauge',
+                            lambda: len(autocomplete_index.entries)))
+registry.add(CallbackMetric('bucket_list_autocomplete_bytes', 'Approximate memory held by the autocomplete index.', 'gauge',
+                            lambda: autocomplete_index.memory_bytes()))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    if 'request_started' in g:
+        labels = (request.endpoint or 'unknown', request.method, str(response.status_code))
+        started = g.request_started
+        if response.is_streamed:
+            # a streamed page renders while it is sent, so it is timed once the body is done
+            response.call_on_close(lambda: request_seconds.observe(labels, time.perf_counter() - started))
+        else:
+            request_seconds.observe(labels, time.perf_counter() - started)
+    return response
+
+# /metrics is only served to these addresses, or to requests carrying METRICS_TOKEN
+METRICS_ALLOWED_IPS = set(filter(None, os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+def metrics_allowed():
+    if request.remote_addr in METRICS_ALLOWED_IPS:
+        return True
+    token = request.headers.get('Authorization', '')
+    return bool(METRICS_TOKEN) and hmac.compare_digest(token.encode(), ('Bearer ' + METRICS_TOKEN).encode())
+
+@app.route('/metrics')
+def metrics():
+    if not metrics_allowed():
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     return render_template('index.html')
 
+# every route that hashes or checks a password: the pool had no room in time
+@app.errorhandler(PasswordsBusy)
+def passwords_busy(e):
+    flash('The server is busy. Please try again in a moment.', 'warning')
+    return redirect(request.url)
+
 @app.route('/register')
 def register():
     return render_template('register.html')
@@ -118,12 +270,17 @@ def add_user():
             'last_name': form['last_name'],
             'username' : form['username'],
             'email': form['email'],
-            'password': form['password'],
+            'password': hash_password(form['password']),
             'role': form['role'],
             'date_added': datetime.datetime.now(),
             'date_modified': datetime.datetime.now()
         }
-        users.insert_one(new_user)
+        try:
+            users.insert_one(new_user)
+        except DuplicateKeyError:
+            # registered by someone else since the checks above
+            flash('That username or email is already registered.', 'warning')
+            return redirect(url_for('register'))
         flash(new_user['username'] + ' user has been added.', 'success')
         
     return render_template('login.html')
@@ -135,7 +292,11 @@ def login():
 
     if request.method == 'POST':
         user = users.find_one({"username": request.form['username']})
-        if user and user['password'] == request.form['password']:
+        if user and check_password(user.get('password'), request.form['password']):
+            if needs_rehash(user['password']):
+                # upgrade plain text and low cost hashes now that we know the password
+                users.update_one({'_id': user['_id']},
+                                 {'$set': {'password': hash_password(request.form['password'])}})
             user_obj = User(username=user['username'], role=user['role'], id=user['_id'])
             login_user(user_obj)
             next_page = request.args.get('next')
@@ -181,25 +342,8 @@ def my_account(user_id):
 @roles_required('contributor', 'admin')
 def update_myaccount(user_id):
     if request.method == 'POST':
-        form = request.form
-
-        password = request.form['password']
-
-        users.update({'_id': ObjectId(user_id)},
-            {
-            'first_name': form['first_name'],
-            'last_name': form['last_name'],
-            'username' : form['username'],
-            'email': form['email'],
-            'password': password,
-            'role': form['role'],
-            'date_added': form['date_added'],
-            'date_modified': datetime.datetime.now()
-            })
-        update_user = users.find_one({'_id': ObjectId(user_id)})
-        flash(update_user['username'] + ' has been updated.', 'success')
-        return redirect(url_for('admin_users'))
-    return render_template('user-admin.html', all_roles=roles.find(), all_users=users.find())
+        return save_user(user_id, 'my_account')
+    return stream_template('user-admin.html', all_roles=reference_data.get('roles'), all_users=repo.user_rows())
 
 
 
@@ -207,13 +351,42 @@ def update_myaccount(user_id):
 def about():
     return render_template('about.html')
 
+# shared by update_myaccount and admin_update_user; edit_endpoint is the form to go back to
+def save_user(user_id, edit_endpoint):
+    form = request.form
+    changes = {
+        'first_name': form['first_name'],
+        'last_name': form['last_name'],
+        'username' : form['username'],
+        'email': form['email'],
+        'role': form['role'],
+    }
+    # a blank password field keeps the current password
+    if form['password']:
+        changes['password'] = hash_password(form['password'])
+
+    try:
+        update_user = update_fields(users, ObjectId(user_id), changes, form_version(form.get('version')))
+    except DuplicateKeyError:
+        flash('That username or email is already registered.', 'warning')
+        return redirect(url_for(edit_endpoint, user_id=user_id))
+    invalidate_user(ObjectId(user_id))
+    if not update_user and not exists(users, ObjectId(user_id)):
+        flash('User not found.', 'warning')
+        return redirect(url_for('admin_users'))
+    if not update_user:
+        flash('This account was changed by someone else while you were editing it. Please make your changes again.', 'warning')
+        return redirect(url_for(edit_endpoint, user_id=user_id))
+    flash(update_user['username'] + ' has been updated.', 'success')
+    return redirect(url_for('admin_users'))
+
 ##########  Admin functionality -- User management ##########
 
 @app.route('/admin/users', methods=['GET', 'POST'])
 @login_required
 @roles_required('admin')
 def admin_users():
-    return render_template('user-admin.html', all_roles=roles.find(), all_users=users.find())
+    return stream_template('user-admin.html', all_roles=reference_data.get('roles'), all_users=repo.user_rows())
 
 @app.route('/admin/add-user', methods=['GET', 'POST'])
 @login_required
@@ -222,12 +395,15 @@ def admin_add_user():
     if request.method == 'POST':
         form = request.form
         
-        password = request.form['password']
-        
         email = users.find_one({"email": request.form['email']})
         if email:
             flash('This email is already registered.', 'warning')
             return 'This email has already been registered.'
+        if users.find_one({"username": request.form['username']}):
+            flash('This username is already registered.', 'warning')
+            return 'This username has already been registered.'
+        # hashed only once the checks pass, since it takes a bcrypt worker
+        password = hash_password(request.form['password'])
         new_user = {
             'first_name': form['first_name'],
             'last_name': form['last_name'],
@@ -238,30 +414,55 @@ def admin_add_user():
             'date_added': datetime.datetime.now(),
             'date_modified': datetime.datetime.now()
         }
-        users.insert_one(new_user)
+        try:
+            users.insert_one(new_user)
+        except DuplicateKeyError:
+            flash('That username or email is already registered.', 'warning')
+            return redirect(url_for('admin_users'))
         flash(new_user['username'] + ' user has been added.', 'success')
         return redirect(url_for('admin_users'))
-    return render_template('user-admin.html', all_roles=roles.find(), all_users=users.find())
+    return stream_template('user-admin.html', all_roles=reference_data.get('roles'), all_users=repo.user_rows())
 
 @app.route('/admin/delete-user/<user_id>', methods=['GET', 'POST'])
 @login_required
 @roles_required('admin')
 def admin_delete_user(user_id):
-    delete_user = users.find_one({'_id': ObjectId(user_id)})
+    delete_user = users.find_one_and_delete({'_id': ObjectId(user_id)})
     if delete_user:
-        users.delete_one(delete_user)
-        flash(delete_user['username'] + ' has been deleted.', 'warning')
+        user_cache.pop(delete_user['username'])
+        job_runner.enqueue('delete_user', username=delete_user['username'], deleted=datetime.datetime.now())
+        flash(delete_user['username'] + ' has been deleted. Their activities are being deleted in the background.', 'warning')
         return redirect(url_for('admin_users'))
     flash('User not found.', 'warning')
     return redirect(url_for('admin_users'))
 
+@app.route('/admin/users/bulk', methods=['POST'])
+@login_required
+@roles_required('admin')
+def bulk_users():
+    form = request.form
+    selected = form.getlist('selected')
+    if form.get('action') == 'delete':
+        result = bulk.delete(users, selected, 'username', {'username': 1})
+        deleted = [before['username'] for before, after in result.changes]
+        if deleted:
+            job_runner.enqueue('delete_user', usernames=deleted, deleted=datetime.datetime.now())
+    elif form.get('action') == 'role' and form.get('role') in [role['role_name'] for role in reference_data.get('roles')]:
+        result = bulk.set_fields(users, selected, {'role': form['role']}, 'username', {'username': 1, 'role': 1})
+    else:
+        flash('Choose an action for the selected users.', 'warning')
+        return redirect(url_for('admin_users'))
+    for before, after in result.changes:
+        user_cache.pop(before['username'])
+    return render_template('bulk-results.html', result=result, kind='users', back=url_for('admin_users'))
+
 @app.route('/admin/edit-user/<user_id>', methods=['GET', 'POST'])
 @login_required
 @roles_required('admin')
 def admin_edit_user(user_id):
     edit_user = users.find_one({'_id': ObjectId(user_id)})
     if edit_user:
-        return render_template('edit-user.html', user=edit_user, all_roles=roles.find())
+        return render_template('edit-user.html', user=edit_user, all_roles=reference_data.get('roles'))
     flash('User not found.', 'warning')
     return redirect(url_for('admin_users'))
 
@@ -270,25 +471,8 @@ def admin_edit_user(user_id):
 @roles_required('admin')
 def admin_update_user(user_id):
     if request.method == 'POST':
-        form = request.form
-
-        password = request.form['password']
-
-        users.update({'_id': ObjectId(user_id)},
-            {
-            'first_name': form['first_name'],
-            'last_name': form['last_name'],
-            'username' : form['username'],
-            'email': form['email'],
-            'password': password,
-            'role': form['role'],
-            'date_added': form['date_added'],
-            'date_modified': datetime.datetime.now()
-            })
-        update_user = users.find_one({'_id': ObjectId(user_id)})
-        flash(update_user['username'] + ' has been updated.', 'success')
-        return redirect(url_for('admin_users'))
-    return render_template('user-admin.html', all_roles=roles.find(), all_users=users.find())
+        return save_user(user_id, 'admin_edit_user')
+    return stream_template('user-admin.html', all_roles=reference_data.get('roles'), all_users=repo.user_rows())
 
 
 
@@ -304,7 +488,7 @@ def admin_update_user(user_id):
 def add_share_status():
     if request.method == 'POST':
         form = request.form
-        share_status = users.find_one({"share_status": request.form['new_share_status']})
+        share_status = status.find_one({"share_status": request.form['new_share_status']})
         if share_status:
             flash('This status is already registered.', 'warning')
             return url_for('/admin_users')
@@ -312,27 +496,53 @@ def add_share_status():
             'share_status': form['share_status'],
         }
         status.insert_one(new_share_status)
-        flash(new_status['share_status'] + ' has been added.', 'success')
+        reference_data.refresh('status')
+        flash(new_share_status['share_status'] + ' has been added.', 'success')
         return redirect(url_for('admin_activities'))
-    return render_template('activity-admin.html', all_status=status.find())  
+    return stream_template('activity-admin.html', all_status=reference_data.get('status'))  
 @app.route('/activities/delete_share_status/<share_status_id>', methods=['GET'])
 @login_required
 @roles_required('admin')
 def delete_share_status(share_status_id):
-    delete_share_status = status.find_one({'_id': ObjectId(category_id)})
+    delete_share_status = status.find_one({'_id': ObjectId(share_status_id)})
     if delete_share_status:
         status.delete_one(delete_share_status)
+        reference_data.refresh('status')
         flash(delete_share_status['share_status'] + ' has been deleted.', 'danger')
         return redirect(url_for('admin_activities'))
     flash('activity not found.', 'warning')
     return redirect(url_for('admin_activities'))
 
+########## statistics ##########
+@app.route('/admin/stats', methods=['GET'])
+@login_required
+@roles_required('admin')
+def admin_stats():
+    rollups = [(dimension, stats.top(activity_stats, dimension)) for dimension in stats.DIMENSIONS]
+    return render_template('admin-stats.html', rollups=rollups)
+
+@app.route('/admin/stats/rebuild', methods=['POST'])
+@login_required
+@roles_required('admin')
+def rebuild_stats():
+    count = stats.rebuild(bucketList, activity_stats)
+    stats.rebuild_user_summaries(bucketList, user_summaries)
+    flash('Statistics have been rebuilt (%d rows).' % count, 'success')
+    return redirect(url_for('admin_stats'))
+
+########## jobs ##########
+@app.route('/admin/jobs', methods=['GET'])
+@login_required
+@roles_required('admin')
+def admin_jobs():
+    return render_template('admin-jobs.html', jobs=job_runner.recent())
+
 ########## categories ##########
 @app.route('/admin/categories', methods=['GET', 'POST'])
 @login_required
 @roles_required('admin')
 def admin_categories():
-    return render_template('admin-categories.html', all_categories=categories.find())
+    return render_template('admin-categories.html', all_categories=reference_data.get('categories'))
 
 
 @app.route('/add-category', methods=[ 'GET','POST'])
@@ -349,9 +559,10 @@ def add_category():
     
         }
         categories.insert_one(new_category)
+        reference_data.refresh('categories')
         flash('New category has been added.', 'success')
         
-    return render_template('admin-categories.html', all_categories=categories.find())
+    return render_template('admin-categories.html', all_categories=reference_data.get('categories'))
 
 @app.route('/categories/edit-category/<category_id>', methods=['GET', 'POST'])
 @login_required
@@ -359,7 +570,7 @@ def add_category():
 def edit_category(category_id):
     edit_category = categories.find_one({'_id': ObjectId(category_id)})
     if edit_category:
-        return render_template('edit-category.html', category=edit_category, all_categories=categories.find(), all_status=status.find())
+        return render_template('edit-category.html', category=edit_category, all_categories=reference_data.get('categories'), all_status=reference_data.get('status'))
     flash('category not found.', 'danger')
     return redirect(url_for('admin_categories'))
 @app.route('/categories/update-category/<category_id>', methods=['POST'])
@@ -368,23 +579,44 @@ def edit_category(category_id):
 def update_category(category_id):
     if request.method == 'POST':
         form = request.form
-        categories.update({'_id': ObjectId(category_id)},
+        fallback = categories.find_one({'_id': ObjectId(category_id), 'category_name': cascades.UNCATEGORIZED})
+        if fallback and form['category_name'] != cascades.UNCATEGORIZED:
+            # the activities of deleted categories go there
+            flash(cascades.UNCATEGORIZED + ' cannot be renamed.', 'warning')
+            return redirect(url_for('admin_categories'))
+        before = update_fields(categories, ObjectId(category_id),
             {
                 'category_name' : form['category_name']
-            
-            })
-        update_category = categories.find_one({'_id': ObjectId(category_id)})
-        flash(update_category['category_name'] + ' has been updated.', 'success')
+            }, form_version(form.get('version')), return_document=ReturnDocument.BEFORE)
+        if not before and not exists(categories, ObjectId(category_id)):
+            flash('Category not found.', 'warning')
+            return redirect(url_for('admin_categories'))
+        if not before:
+            flash('This category was changed by someone else while you were editing it. Please make your changes again.', 'warning')
+            return redirect(url_for('edit_category', category_id=category_id))
+        reference_data.refresh('categories')
+        if before['category_name'] != form['category_name']:
+            job_runner.enqueue('rename_category', old=before['category_name'], new=form['category_name'])
+            flash(form['category_name'] + ' has been updated. Its activities are being renamed in the background.', 'success')
+        else:
+            flash(form['category_name'] + ' has been updated.', 'success')
         return redirect(url_for('admin_categories'))
-    return render_template('edit-category.html', all_categories=categories.find())
+    return render_template('edit-category.html', all_categories=reference_data.get('categories'))
 @app.route('/categories/delete-category/<category_id>', methods=['POST'])
 @login_required
 @roles_required('admin')
 def delete_category(category_id):
     delete_category = categories.find_one({'_id': ObjectId(category_id)})
+    if delete_category and delete_category['category_name'] == cascades.UNCATEGORIZED:
+        # the activities of deleted categories go there
+        flash(cascades.UNCATEGORIZED + ' cannot be deleted.', 'warning')
+        return redirect(url_for('admin_categories'))
     if delete_category:
         categories.delete_one(delete_category)
-        flash(delete_category['category_name'] + ' has been deleted.', 'danger')
+        reference_data.refresh('categories')
+        job_runner.enqueue('delete_category', name=delete_category['category_name'])
+        flash(delete_category['category_name'] + ' has been deleted. Its activities are being moved to '
+              + cascades.UNCATEGORIZED + ' in the background.', 'danger')
         return redirect(url_for('admin_categories'))
     flash('activity not found.', 'warning')
     return redirect(url_for('admin_categories'))
@@ -394,7 +626,58 @@ def delete_category(category_id):
 @app.route('/activities', methods=['GET', 'POST'])
 
 def view_activities():
-    return render_template('activities.html', all_bucketList=bucketList.find())
+    etag, last_modified = listing_validators()
+    if is_not_modified(etag, last_modified):
+        return not_modified(etag, last_modified)
+    page = repo.public_activities(after=request.args.get('after'),
+                                  before=request.args.get('before'),
+                                  per_page=request.args.get('per_page'),
+                                  filters=request.args)
+    return with_validators(activities_response(page), etag, last_modified)
+
+# listings change whenever any activity does, so they share the bucketList change counter
+def listing_validators(counter=None):
+    # counter is the (version, date_modified) already read by the async routes
+    version, last_modified = counter or collection_version(public_counters, 'bucketList')
+    return page_etag(version, current_user.get_id()), last_modified
+
+# the render half of the read-heavy pages is shared with the async routes in asgi.py
+def activities_response(page):
+    return stream_template('activities.html', all_bucketList=page.rows, page=page)
+
+
+@app.route('/activities/near', methods=['GET'])
+def view_nearby_activities():
+    etag, last_modified = listing_validators()
+    if is_not_modified(etag, last_modified):
+        return not_modified(etag, last_modified)
+    location = request_point(request.args)
+    page = None
+    if location:
+        args = {arg: request.args[arg] for arg in ('place', 'lat', 'lon', 'radius') if request.args.get(arg)}
+        page = repo.nearby_activities(location,
+                                      radius=request.args.get('radius'),
+                                      page=request.args.get('page'),
+                                      per_page=request.args.get('per_page'),
+                                      args=args)
+    return with_validators(render_template('near.html', all_bucketList=page.rows if page else [], page=page,
+                                           location=location, radius=radius_km(request.args.get('radius'))),
+                           etag, last_modified)
+
+
+@app.route('/activities/live', methods=['GET'])
+def live_activities():
+    # Server-Sent Events for the public list. A browser that lost its connection
+    # sends the id of the last event it got, and is sent what it missed first
+    if live_feed.unsupported:
+        # 204 tells EventSource to stop reconnecting
+        return Response(status=204)
+    last_id = request.headers.get('Last-Event-ID')
+    response = Response(sse_lines(live_feed.stream(last_id, max_seconds=LIVE_MAX_SECONDS)),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @app.route('/jump', methods=['GET', 'POST'])
@@ -407,13 +690,50 @@ def view_jump():
 
 @app.route('/search-results', methods=['GET', 'POST'])
 def view_search_results():
-    return render_template('search-results.html', search_string=search_string, all_bucketList=bucketList.find())
+    etag, last_modified = listing_validators()
+    if is_not_modified(etag, last_modified):
+        return not_modified(etag, last_modified)
+    search_string = request.args.get('q', '')
+    page = repo.search_activities(search_string,
+                                  page=request.args.get('page'),
+                                  per_page=request.args.get('per_page'))
+    return with_validators(search_results_response(search_string, page), etag, last_modified)
+
+def search_results_response(search_string, page):
+    return render_template('search-results.html', search_string=search_string, all_bucketList=page.rows, page=page)
 @app.route('/search', methods=['GET', 'POST'])
 def search():
     if request.method == 'POST':
-        form = request.form
         search_string = request.form['search_string']
-    return render_template('search-results.html', search_string=search_string, all_bucketList=bucketList.find())
+    else:
+        search_string = request.args.get('q', '')
+    return redirect(url_for('view_search_results', q=search_string))
+
+@app.route('/autocomplete')
+def autocomplete():
+    if autocomplete_index.built is None:
+        # warmup didn't build it (not started through create_app): the first request
+        # starts the only build, in the background, and there are no suggestions until it ends
+        version = collection_version(counters, 'bucketList')[0]
+        autocomplete_index.refresh_in_background(bucketList, version, AUTOCOMPLETE_REBUILD_SECONDS)
+        return jsonify([])
+    if autocomplete_index.check_due(AUTOCOMPLETE_CHECK_SECONDS):
+        # other processes' writes only reach this index through a rebuild
+        version = collection_version(counters, 'bucketList')[0]
+        autocomplete_index.refresh_in_background(bucketList, version, AUTOCOMPLETE_REBUILD_SECONDS)
+    limit = request.args.get('limit', '')
+    suggestions = autocomplete_index.lookup(request.args.get('q', ''), int(limit) if limit.isdigit() else 10)
+    response = jsonify(suggestions)
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response
+
+def build_autocomplete_index():
+    started = time.perf_counter()
+    autocomplete_index.build(bucketList, collection_version(counters, 'bucketList')[0])
+    index_stats = autocomplete_index.stats()
+    log.info('Built the autocomplete index: %d entries, %d bytes in %.3fs.',
+             index_stats['entries'], index_stats['bytes'], time.perf_counter() - started)
 
 
 
@@ -425,7 +745,14 @@ def search():
 @login_required
 @roles_required('admin', 'contributor')
 def view_my_activities():
-    return render_template('my-bucket-list.html', all_bucketList=bucketList.find())
+    username = current_user.username
+    page = repo.user_activities(username,
+                                after=request.args.get('after'),
+                                before=request.args.get('before'),
+                                per_page=request.args.get('per_page'))
+    upcoming_count, upcoming = repo.upcoming_activities(username)
+    return stream_template('my-bucket-list.html', all_bucketList=page.rows, page=page,
+                           summary=dict(repo.user_summary(username), upcoming=upcoming_count), upcoming=upcoming)
 
 
 
@@ -433,13 +760,41 @@ def view_my_activities():
 @login_required
 @roles_required('admin')
 def admin_activities():
-    return render_template('activity-admin.html', all_categories=categories.find(), all_bucketList=bucketList.find(), all_status=status.find())
+    return stream_template('activity-admin.html', all_categories=reference_data.get('categories'), all_bucketList=repo.activity_rows(), all_status=reference_data.get('status'))
+
+########## exports ##########
+def export_response(scope, query, sort=None, collection=None):
+    # the cursor is only run once the response starts streaming
+    fmt = export_format(request.args.get('format'))
+    cursor = export_cursor(collection or bucketList, query, sort)
+    response = Response(stream_with_context(export_chunks(cursor, fmt)), mimetype=FORMATS[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename="%s"' % export_filename(scope, fmt)
+    # ask proxies to pass the rows on as they come instead of buffering the whole export
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/activities/export', methods=['GET'])
+def export_public_activities():
+    return export_response('public', {'share_status': 'Public'}, SORT_DESC, collection=repo.public)
+
+@app.route('/activities/my-bucket-list/export', methods=['GET'])
+@login_required
+@roles_required('admin', 'contributor')
+def export_my_activities():
+    return export_response('mine', {'username': current_user.username}, SORT_DESC)
+
+@app.route('/activities/activities/export', methods=['GET'])
+@login_required
+@roles_required('admin')
+def export_all_activities():
+    return export_response('all', {})
+
 
 @app.route('/activities/new-activity', methods=['GET', 'POST'])
 @login_required
 @roles_required('admin', 'contributor')
 def activity_page():
-    return render_template('new-activity.html', all_categories=categories.find(), all_bucketList=bucketList.find(), all_status=status.find())
+    return render_template('new-activity.html', all_categories=reference_data.get('categories'), all_status=reference_data.get('status'))
 
 
 
@@ -470,10 +825,44 @@ def add_activity():
         'date_modified': datetime.datetime.now()
     
         }
-        bucketList.insert_one(new_activity)
+        bucketList.insert_one(geocode_activity(normalize_activity(new_activity)))
+        version = bump_version(counters, 'bucketList')['version']
+        stats.apply_change(activity_stats, after=new_activity)
+        stats.apply_user_change(user_summaries, after=new_activity)
+        autocomplete_index.apply_change(after=new_activity, version=version)
+        related_index.apply_change(after=new_activity)
         flash('New activity has been added.', 'success')
         return redirect(url_for('view_my_activities'))
-    return render_template('new-activity.html', all_categories=categories.find())
+    return render_template('new-activity.html', all_categories=reference_data.get('categories'))
+
+# what the statistics, user summaries, autocomplete and related indexes need from a changed activity
+BULK_ACTIVITY_FIELDS = {field: 1 for field in stats.FIELDS + ('activity_name', 'city', 'description')}
+
+@app.route('/activities/bulk', methods=['POST'])
+@login_required
+@roles_required('admin')
+def bulk_activities():
+    form = request.form
+    selected = form.getlist('selected')
+    action = form.get('action')
+    if action == 'delete':
+        result = bulk.delete(bucketList, selected, 'activity_name', BULK_ACTIVITY_FIELDS)
+    elif action == 'share_status' and form.get('share_status') in [s['share_status'] for s in reference_data.get('status')]:
+        result = bulk.set_fields(bucketList, selected, {'share_status': form['share_status']}, 'activity_name',
+                                 BULK_ACTIVITY_FIELDS)
+    elif action == 'category' and form.get('category') in [c['category_name'] for c in reference_data.get('categories')]:
+        result = bulk.set_fields(bucketList, selected, {'category': form['category']}, 'activity_name',
+                                 BULK_ACTIVITY_FIELDS)
+    else:
+        flash('Choose an action for the selected activities.', 'warning')
+        return redirect(url_for('admin_activities'))
+    if result.changes:
+        version = bump_version(counters, 'bucketList')['version']
+        stats.apply_changes(activity_stats, result.changes)
+        stats.apply_user_changes(user_summaries, result.changes)
+        autocomplete_index.apply_changes(result.changes, version)
+        related_index.apply_changes(result.changes)
+    return render_template('bulk-results.html', result=result, kind='activities', back=url_for('admin_activities'))
 
 @app.route('/activities/edit-activity/<activity_id>', methods=['GET', 'POST'])
 @login_required
@@ -481,7 +870,7 @@ def add_activity():
 def edit_activity(activity_id):
     edit_activity = bucketList.find_one({'_id': ObjectId(activity_id)})
     if edit_activity:
-        return render_template('edit-activity.html', activity=edit_activity, all_categories=categories.find(), all_status=status.find())
+        return render_template('edit-activity.html', activity=edit_activity, all_categories=reference_data.get('categories'), all_status=reference_data.get('status'))
     flash('activity not found.', 'danger')
     return redirect(url_for('admin_activities'))
 @app.route('/activities/update-activity/<activity_id>', methods=['POST'])
@@ -490,8 +879,7 @@ def edit_activity(activity_id):
 def update_activity(activity_id):
     if request.method == 'POST':
         form = request.form
-        bucketList.update({'_id': ObjectId(activity_id)},
-            {
+        changes = {
                 'activity_name' : form['activity_name'],
                 'category' : form['category'],
                 'description' : form['description'],
@@ -502,28 +890,39 @@ def update_activity(activity_id):
                 'state' : form['state'],
                 'country' : form['country'],
                 'expected_date' : form['expected_date'],
-                
-                'username' : form['username'],
-
-                'date_added': form['date_added'],
-                'date_modified': datetime.datetime.now()
-
-
-           
-            })
-        update_activity = bucketList.find_one({'_id': ObjectId(activity_id)})
+            }
+        geocode_activity(normalize_activity(changes))
+        before = update_fields(bucketList, ObjectId(activity_id), changes, form_version(form.get('version')),
+                               return_document=ReturnDocument.BEFORE)
+        if not before and not exists(bucketList, ObjectId(activity_id)):
+            flash('activity not found.', 'warning')
+            return redirect(url_for('admin_activities'))
+        if not before:
+            flash('This activity was changed by someone else while you were editing it. Please make your changes again.', 'warning')
+            return redirect(url_for('edit_activity', activity_id=activity_id))
+        update_activity = dict(before, **changes)
+        version = bump_version(counters, 'bucketList')['version']
+        stats.apply_change(activity_stats, before, update_activity)
+        stats.apply_user_change(user_summaries, before, update_activity)
+        autocomplete_index.apply_change(before, update_activity, version)
+        related_index.apply_change(before, update_activity)
         flash(update_activity['activity_name'] + ' has been updated.', 'success')
         return redirect(url_for('view_activities'))
-    return render_template('edit-activity.html', all_categories=categories.find())
+    return render_template('edit-activity.html', all_categories=reference_data.get('categories'))
 
 
 @app.route('/activities/delete-activity/<activity_id>', methods=['POST'])
 @login_required
 @roles_required('admin', 'contributor' )
 def delete_activity(activity_id):
-    delete_activity = bucketList.find_one({'_id': ObjectId(activity_id)})
+    # the rollups come off only for the document this request actually deleted
+    delete_activity = bucketList.find_one_and_delete({'_id': ObjectId(activity_id)})
     if delete_activity:
-        bucketList.delete_one(delete_activity)
+        version = bump_version(counters, 'bucketList')['version']
+        stats.apply_change(activity_stats, before=delete_activity)
+        stats.apply_user_change(user_summaries, before=delete_activity)
+        autocomplete_index.apply_change(before=delete_activity, version=version)
+        related_index.apply_change(before=delete_activity)
         flash(delete_activity['activity_name'] + ' has been deleted.', 'danger')
         return redirect(url_for('view_activities'))
     flash('activity not found.', 'warning')
@@ -532,12 +931,47 @@ def delete_activity(activity_id):
 @app.route('/activities/print-activity/<activity_id>', methods=['GET', 'POST'])
 
 def print_activity(activity_id):
-    print_activity = bucketList.find_one({'_id': ObjectId(activity_id)})
+    activity = repo.get_activity(activity_id)
+    if not activity:
+        return print_activity_response(activity)
+    related = repo.related_activities(activity['_id'])
+    etag, last_modified = print_activity_validators(activity, related)
+    if is_not_modified(etag, last_modified):
+        return not_modified(etag, last_modified)
+    return with_validators(print_activity_response(activity, related), etag, last_modified)
+
+def print_activity_validators(activity, related):
+    # the page changes when either the activity or its related list does
+    last_modified = max(activity['date_modified'], related['date_modified']) if related else activity['date_modified']
+    return page_etag(last_modified, current_user.get_id()), last_modified
+
+def print_activity_response(print_activity, related=None):
     if print_activity:
-        return render_template('print-activity.html', activity=print_activity)
+        return render_template('print-activity.html', activity=print_activity,
+                               related=related['related'] if related else [])
     flash('activity not found.', 'danger')
     return redirect(url_for('view_activities'))
 
 
+########## startup ##########
+def warmup():
+    # opens this worker's Mongo connections, creates the indexes and loads the
+    # reference data, so the first requests it serves don't pay for any of it
+    connections = int(os.getenv('MONGO_WARMUP_CONNECTIONS') or os.getenv('MONGO_MIN_POOL_SIZE') or 1)
+    elapsed = client.warmup(connections)
+    app.try_trigger_before_first_request_functions()
+    for name in ('categories', 'status', 'roles'):
+        reference_data.get(name)
+    build_autocomplete_index()
+    related_index.load()
+    log.info('Opened %d Mongo connection(s) in %.3fs.', connections, elapsed)
+
+def create_app():
+    # entry point for prefork WSGI servers, e.g. gunicorn 'app:create_app()'. It runs
+    # in each worker after the fork, so the worker is connected before it takes traffic
+    warmup()
+    return app
+
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,247 @@
+import asyncio
+import os
+import re
+from urllib.parse import parse_qsl
+from asgiref.wsgi import WsgiToAsgi
+from flask import session
+from motor.motor_asyncio import AsyncIOMotorClient
+from werkzeug.test import EnvironBuilder
+import app as bucket_list
+from repository import AsyncRepository
+from database import client_options, public_read_preference
+from livefeed import HEARTBEAT_SECONDS, RESET, RETRY_MESSAGE, sse_message
+
+# Serve with an ASGI server, e.g. `uvicorn asgi:application`.
+#
+# GET requests for the read-heavy pages fetch their data through motor, so one
+# process can wait on many Mongo calls at once. Everything else, and any request
+# these routes don't match, goes to the regular Flask app in a thread pool.
+
+
+class AsyncSubscriber:
+    # a livefeed subscriber on the event loop; the feed's watcher thread hands each
+    # event over to the loop
+    def __init__(self, loop, size):
+        self.loop = loop
+        self.queue = asyncio.Queue(size)
+        self.dropped = False
+
+    def deliver(self, event):
+        if not self.dropped:
+            self.loop.call_soon_threadsafe(self.put, event)
+        return not self.dropped
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped = True
+
+
+class AsyncRoutes:
+    def __init__(self, flask_app, repository):
+        self.flask_app = flask_app
+        self.repository = repository
+        self.fallback = WsgiToAsgi(flask_app)
+        self.routes = [
+            (re.compile(r'^/activities$'), self.view_activities),
+            (re.compile(r'^/search-results$'), self.view_search_results),
+            (re.compile(r'^/activities/print-activity/(?P<activity_id>[^/]+)$'), self.print_activity),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] == '/activities/live':
+            # served here instead of by the Flask route, which would hold a thread pool
+            # thread for as long as the browser stays connected
+            await self.live_activities(scope, receive, send)
+            return
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+            for pattern, handler in self.routes:
+                match = pattern.match(scope['path'])
+                if match:
+                    await self.dispatch(scope, send, handler, match.groupdict())
+                    return
+        await self.fallback(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        # the server waits for startup to complete before it sends this worker requests
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await asyncio.get_event_loop().run_in_executor(None, bucket_list.warmup)
+                    await self.repository.db.command('ping')
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def environ(self, scope):
+        headers = [(name.decode('latin1'), value.decode('latin1')) for name, value in scope['headers']]
+        return EnvironBuilder(path=scope.get('root_path', '') + scope['path'],
+                              query_string=scope['query_string'].decode('latin1'),
+                              method=scope['method'],
+                              headers=headers).get_environ()
+
+    async def dispatch(self, scope, send, handler, kwargs):
+        environ = self.environ(scope)
+        args = dict(parse_qsl(scope['query_string'].decode('latin1')))
+
+        # the request context is only ever pushed between awaits, never across one,
+        # because the Flask context stack is shared by every coroutine on this thread
+        with self.flask_app.request_context(environ):
+            username = session.get('_user_id')
+        user = await self.load_user(username)
+
+        def in_context(func):
+            # runs func in this request's Flask context, with its user logged in
+            with self.flask_app.request_context(environ) as ctx:
+                ctx.user = user or self.flask_app.login_manager.anonymous_user()
+                return func()
+
+        data = await handler(in_context, args, **kwargs)
+
+        def finish():
+            response = self.respond(data)
+            body = b'' if scope['method'] == 'HEAD' else response.get_data()
+            # as a WSGI server would once the body is sent, e.g. for the request timing
+            response.close()
+            headers = [(name.encode('latin1'), value.encode('latin1')) for name, value in response.headers.items()]
+            return response.status_code, headers, body
+
+        status, headers, body = in_context(finish)
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def respond(self, render):
+        # the parts of Flask's full_dispatch_request around the view itself
+        self.flask_app.try_trigger_before_first_request_functions()
+        rv = self.flask_app.preprocess_request()
+        if rv is None:
+            rv = render()
+        return self.flask_app.finalize_request(rv)
+
+    async def live_activities(self, scope, receive, send):
+        feed = bucket_list.live_feed
+        if feed.unsupported:
+            await send({'type': 'http.response.start', 'status': 204, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        last_id = dict(scope['headers']).get(b'last-event-id', b'').decode('latin1') or None
+        loop = asyncio.get_event_loop()
+        subscriber = AsyncSubscriber(loop, feed.queue_size)
+        feed.subscribe(subscriber)
+        disconnected = asyncio.ensure_future(self.wait_for_disconnect(receive))
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                                    (b'cache-control', b'no-cache'),
+                                    (b'x-accel-buffering', b'no')]})
+            await send({'type': 'http.response.body', 'body': RETRY_MESSAGE.encode(), 'more_body': True})
+            async for event in self.live_events(feed, subscriber, last_id, loop):
+                if disconnected.done():
+                    return
+                await send({'type': 'http.response.body', 'body': sse_message(event).encode('utf-8'),
+                            'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            feed.unsubscribe(subscriber)
+
+    async def live_events(self, feed, subscriber, last_id, loop):
+        # as ChangeFeed.stream, waiting on the loop instead of a thread
+        if last_id:
+            missed = await loop.run_in_executor(None, feed.missed, last_id)
+            if missed is None:
+                yield RESET
+                return
+            for event in missed:
+                yield event
+                last_id = event[0]
+        while not (subscriber.dropped and subscriber.queue.empty()):
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                if feed.unsupported:
+                    return
+                yield None
+                continue
+            if event[0] and last_id and event[0] <= last_id:
+                continue
+            last_id = event[0] or last_id
+            yield event
+
+    async def wait_for_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def load_user(self, username):
+        if not username:
+            return None
+        user = bucket_list.user_cache.get(username)
+        if user:
+            return user
+        u = await self.repository.get_user(username)
+        if not u:
+            return None
+        user = bucket_list.User(username=u['username'], role=u['role'], id=u['_id'])
+        bucket_list.user_cache.set(username, user)
+        return user
+
+    def validate(self, in_context, validators):
+        # (etag, last_modified, whether the browser's copy is still current)
+        def check():
+            etag, last_modified = validators()
+            return etag, last_modified, bucket_list.is_not_modified(etag, last_modified)
+        return in_context(check)
+
+    async def listing(self, in_context, fetch, render):
+        # the listings are validated by the change counter before their rows are fetched
+        counter = await self.repository.collection_version('bucketList')
+        etag, last_modified, current = self.validate(in_context, lambda: bucket_list.listing_validators(counter))
+        if current:
+            return lambda: bucket_list.not_modified(etag, last_modified)
+        data = await fetch()
+        return lambda: bucket_list.with_validators(render(data), etag, last_modified)
+
+    async def view_activities(self, in_context, args):
+        return await self.listing(in_context,
+                                  lambda: self.repository.public_activities(after=args.get('after'),
+                                                                            before=args.get('before'),
+                                                                            per_page=args.get('per_page'),
+                                                                            filters=args),
+                                  bucket_list.activities_response)
+
+    async def view_search_results(self, in_context, args):
+        search_string = args.get('q', '')
+        return await self.listing(in_context,
+                                  lambda: self.repository.search_activities(search_string,
+                                                                            page=args.get('page'),
+                                                                            per_page=args.get('per_page')),
+                                  lambda page: bucket_list.search_results_response(search_string, page))
+
+    async def print_activity(self, in_context, args, activity_id):
+        activity = await self.repository.get_activity(activity_id)
+        if not activity:
+            return lambda: bucket_list.print_activity_response(activity)
+        related = await self.repository.related_activities(activity['_id'])
+        etag, last_modified, current = self.validate(
+            in_context, lambda: bucket_list.print_activity_validators(activity, related))
+        if current:
+            return lambda: bucket_list.not_modified(etag, last_modified)
+        return lambda: bucket_list.with_validators(bucket_list.print_activity_response(activity, related),
+                                                   etag, last_modified)
+
+
+client = AsyncIOMotorClient(os.getenv('MONGO'), **client_options())
+# the live list is served on the event loop here, so pages can always open it
+bucket_list.app.config['LIVE_UPDATES'] = True
+application = AsyncRoutes(bucket_list.app, AsyncRepository(client[os.getenv('MONGO_DB', 'bucket_list')],
+                                                           public_read_preference()))
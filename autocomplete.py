@@ -0,0 +1,153 @@
+import bisect
+import sys
+import threading
+import time
+from geocode import normalize_name
+
+# Search-as-you-type suggestions from public activity names, categories and cities,
+# held in memory as one sorted list searched with bisect. Each entry is a single
+# string, 'key\x1fkind\x1ftext', so a prefix lookup is a bisect for the prefix
+# followed by a walk over the entries that start with it, and shorter keys sort
+# ahead of longer ones that extend them. counts holds how many public activities
+# contribute each entry, so it only leaves the index when the last one goes.
+
+KINDS = (('activity_name', 'activity'), ('category', 'category'), ('city', 'city'))
+SEPARATOR = '\x1f'
+MAX_SUGGESTIONS = 20
+
+
+def entry(kind, text):
+    key = normalize_name(text)
+    if not key:
+        return None
+    return SEPARATOR.join((key, kind, text.strip()))
+
+
+def activity_entries(activity):
+    if activity.get('share_status') != 'Public':
+        return []
+    entries = (entry(kind, activity.get(field) or '') for field, kind in KINDS)
+    return [e for e in entries if e]
+
+
+class PrefixIndex:
+    def __init__(self):
+        self.entries = []
+        self.counts = {}
+        self.string_bytes = 0       # the entry strings; the containers are measured in stats()
+        self.version = None         # bucketList change counter the index reflects
+        self.built = None           # time.monotonic() of the last full build
+        self.checked = 0            # time.monotonic() of the last check_due that returned True
+        self._lock = threading.Lock()
+        self._building = False
+
+    def load(self, entries, version=None):
+        # replaces the whole index; entries is any iterable of entry strings
+        counts = {}
+        for e in entries:
+            counts[e] = counts.get(e, 0) + 1
+        ordered = sorted(counts)
+        string_bytes = sum(sys.getsizeof(e) for e in ordered)
+        with self._lock:
+            self.entries = ordered
+            self.counts = counts
+            self.string_bytes = string_bytes
+            self.version = version
+            self.built = time.monotonic()
+
+    def build(self, bucketList, version=None):
+        fields = {field: 1 for field, kind in KINDS}
+        fields['share_status'] = 1
+        cursor = bucketList.find({'share_status': 'Public'}, fields, batch_size=5000)
+        self.load((e for activity in cursor for e in activity_entries(activity)), version)
+        return len(self.entries)
+
+    def add(self, e):
+        count = self.counts.get(e, 0)
+        self.counts[e] = count + 1
+        if not count:
+            bisect.insort(self.entries, e)
+            self.string_bytes += sys.getsizeof(e)
+
+    def remove(self, e):
+        count = self.counts.get(e, 0)
+        if count > 1:
+            self.counts[e] = count - 1
+        elif count:
+            del self.counts[e]
+            i = bisect.bisect_left(self.entries, e)
+            if i < len(self.entries) and self.entries[i] == e:
+                del self.entries[i]
+            self.string_bytes -= sys.getsizeof(e)
+
+    def apply_change(self, before=None, after=None, version=None):
+        # before/after as for stats.apply_change; version is the change counter after
+        # this write, which the index has now caught up with if it was current before
+        self.apply_changes([(before, after)], version)
+
+    def apply_changes(self, changes, version=None):
+        with self._lock:
+            for before, after in changes:
+                for e in activity_entries(before or {}):
+                    self.remove(e)
+                for e in activity_entries(after or {}):
+                    self.add(e)
+            if version is not None and self.version is not None and version == self.version + 1:
+                self.version = version
+
+    def lookup(self, prefix, limit=10):
+        key = normalize_name(prefix)
+        if not key:
+            return []
+        limit = max(1, min(limit, MAX_SUGGESTIONS))
+        suggestions = []
+        seen = set()
+        with self._lock:
+            i = bisect.bisect_left(self.entries, key)
+            while i < len(self.entries) and len(suggestions) < limit:
+                e = self.entries[i]
+                if not e.startswith(key):
+                    break
+                entry_key, kind, text = e.split(SEPARATOR)
+                if (kind, entry_key) not in seen:
+                    seen.add((kind, entry_key))
+                    suggestions.append({'text': text, 'kind': kind})
+                i += 1
+        return suggestions
+
+    def check_due(self, interval):
+        # True at most once per interval seconds, for the caller to compare version
+        # with the change counter
+        now = time.monotonic()
+        with self._lock:
+            if now - self.checked < interval:
+                return False
+            self.checked = now
+            return True
+
+    def refresh_in_background(self, bucketList, version, min_interval=30):
+        # another process changed bucketList; rebuild without blocking lookups, at
+        # most once per min_interval seconds
+        with self._lock:
+            if self._building or version == self.version:
+                return False
+            if self.built is not None and time.monotonic() - self.built < min_interval:
+                return False
+            self._building = True
+
+        def rebuild():
+            try:
+                self.build(bucketList, version)
+            finally:
+                self._building = False
+
+        threading.Thread(target=rebuild, name='autocomplete-rebuild', daemon=True).start()
+        return True
+
+    def memory_bytes(self):
+        # the entry strings plus the list and dict that hold them; counts shares its
+        # keys with entries, and the small ints are cached by Python
+        return self.string_bytes + sys.getsizeof(self.entries) + sys.getsizeof(self.counts)
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.memory_bytes(), 'version': self.version}
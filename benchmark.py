@@ -0,0 +1,503 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import pymongo
+from bson.objectid import ObjectId
+from dotenv import load_dotenv
+from search import ensure_text_index
+from indexes import INDEXES
+from geocode import gazetteer
+from repository import Repository, object_id
+from rows import ActivityRow, UserRow
+from datagen import ACTIVITIES, CATEGORIES, PLACES, generate_activities, generate_user, generate_users, insert_batches
+from autocomplete import PrefixIndex, activity_entries
+import related
+import bulk
+import passwords
+
+## necessary for python-dotenv ##
+APP_ROOT = os.path.join(os.path.dirname(__file__), '..')   # refers to application_top
+dotenv_path = os.path.join(APP_ROOT, '.env')
+load_dotenv(dotenv_path)
+
+# benchmarks run against their own database so they never touch real data
+BENCH_DB = os.getenv('BENCH_DB', 'bucket_list_bench')
+
+SEARCHES = ['skydiving', 'museum kyoto', 'Nature', 'reykjavik northern lights', 'festival', 'castle edinburgh']
+NEAR_PLACES = ['Moab, UT', 'Paris', 'Kyoto', 'Cape Town', 'Sydney', 'Banff']
+
+
+def get_db():
+    return pymongo.MongoClient(os.getenv('MONGO'))[BENCH_DB]
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(name, samples):
+    return {
+        'name': name,
+        'count': len(samples),
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p95_ms': percentile(samples, 95) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+    }
+
+
+def seed_activities(collection, count):
+    collection.drop()
+    insert_batches(collection, generate_activities(count), batch_size=10000, label='seeding %d' % count)
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+
+def time_calls(func, args_list, repeat):
+    samples = []
+    for _ in range(repeat):
+        for args in args_list:
+            started = time.perf_counter()
+            func(*args)
+            samples.append(time.perf_counter() - started)
+    return samples
+
+
+def bench_search(db, sizes, repeat):
+    results = []
+    collection = db['bucketList']
+    for size in sizes:
+        seed_activities(collection, size)
+        ensure_text_index(collection)
+        repo = Repository(db)
+        samples = time_calls(lambda q: repo.search_activities(q).rows,
+                             [(q,) for q in SEARCHES], repeat)
+        result = summarize('search', samples)
+        result['size'] = size
+        results.append(result)
+    return results
+
+
+def bench_near(db, sizes, radii, repeat):
+    # nearest public activities around each generated city, first page and a deep page
+    results = []
+    collection = db['bucketList']
+    location_index = [index for index in INDEXES['bucketList'] if index.document['name'] == 'location_share_status']
+    centres = [(location,) for location in list(gazetteer.cities.values())[:28]]
+    for size in sizes:
+        seed_activities(collection, size)
+        collection.create_indexes(location_index)
+        repo = Repository(db)
+        for radius in radii:
+            for page in (1, 5):
+                samples = time_calls(lambda location: repo.nearby_activities(location, radius, page).rows,
+                                     centres, repeat)
+                result = summarize('near/%gkm/page%d' % (radius, page), samples)
+                result['size'] = size
+                results.append(result)
+    return results
+
+
+def bench_passwords(rounds_list, logins, threads):
+    # logins/sec for one worker process verifying passwords from several request threads
+    results = []
+    for rounds in rounds_list:
+        stored = passwords.hash_password('correct horse battery staple', rounds)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            samples = list(pool.map(lambda _: timed(passwords.check_password, stored, 'correct horse battery staple'),
+                                    range(logins)))
+        elapsed = time.perf_counter() - started
+        result = summarize('login', samples)
+        result['size'] = 'cost=%d' % rounds
+        result['per_sec'] = logins / elapsed
+        results.append(result)
+    return results
+
+
+########## routes ##########
+BENCH_PASSWORD = 'abc123'
+
+
+def use_mongomock():
+    # in-memory stand-in for a local mongod; every client shares one store. mongomock
+    # has no $text or $geoNear support, so the search and near routes are skipped when it is in use
+    import mongomock
+    client = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *args, **kwargs: client
+
+
+def seed_app_data(db, size):
+    for name in ('users', 'bucketList', 'categories', 'status', 'roles'):
+        db[name].drop()
+    user_count = max(10, size // 100)
+    password_hash = passwords.hash_password(BENCH_PASSWORD, rounds=4)
+    insert_batches(db['users'], generate_users(user_count, password=password_hash), label='users', progress=False)
+    insert_batches(db['bucketList'], generate_activities(size, users=user_count), batch_size=10000,
+                   label='seeding %d' % size)
+    db['categories'].insert_many([{'category_name': name} for name in CATEGORIES])
+    db['status'].insert_many([{'share_status': 'Public'}, {'share_status': 'Private'}])
+    db['roles'].insert_many([{'role_name': 'admin'}, {'role_name': 'contributor'}])
+
+
+def logged_in_client(flask_app, username):
+    client = flask_app.test_client()
+    client.post('/login', data={'username': username, 'password': BENCH_PASSWORD})
+    return client
+
+
+def bench_routes(sizes, requests, skip_search=False):
+    # imported here so MONGO_DB and the mongomock patch are in place first
+    import app as bucket_list
+    flask_app = bucket_list.app
+    db = bucket_list.db
+    admin = generate_user(0)['username']
+
+    results = []
+    for size in sizes:
+        seed_app_data(db, size)
+        bucket_list.user_cache.clear()
+        anonymous = flask_app.test_client()
+        admin_client = logged_in_client(flask_app, admin)
+        ids = [str(doc['_id']) for doc in db['bucketList'].find({}, {'_id': 1}).limit(1000)]
+        rng = random.Random(0)
+
+        cases = [
+            ('/activities', lambda: anonymous.get('/activities')),
+            ('/activities/print-activity', lambda: anonymous.get('/activities/print-activity/' + rng.choice(ids))),
+            ('/activities/my-bucket-list', lambda: admin_client.get('/activities/my-bucket-list')),
+            ('/login', lambda: flask_app.test_client().post('/login', data={'username': admin, 'password': BENCH_PASSWORD})),
+            ('/admin/users', lambda: admin_client.get('/admin/users')),
+            ('/admin/categories', lambda: admin_client.get('/admin/categories')),
+            ('/activities/activities', lambda: admin_client.get('/activities/activities')),
+        ]
+        if not skip_search:
+            cases.append(('/search-results', lambda: anonymous.get('/search-results?q=' + rng.choice(SEARCHES))))
+            cases.append(('/activities/near', lambda: anonymous.get('/activities/near?radius=250&place=' + rng.choice(NEAR_PLACES))))
+
+        for name, call in cases:
+            call()   # warm up caches and the first request hooks
+            samples = []
+            started = time.perf_counter()
+            for _ in range(requests):
+                request_started = time.perf_counter()
+                response = call()
+                samples.append(time.perf_counter() - request_started)
+                if response.status_code >= 400:
+                    raise RuntimeError('%s returned %d' % (name, response.status_code))
+            elapsed = time.perf_counter() - started
+            result = summarize(name, samples)
+            result['size'] = size
+            result['per_sec'] = requests / elapsed
+            results.append(result)
+    return results
+
+
+########## exports ##########
+def stream_export(client, url):
+    # seconds to the first chunk, seconds to the last and bytes streamed
+    started = time.perf_counter()
+    response = client.get(url, buffered=False)
+    if response.status_code != 200:
+        raise RuntimeError('%s returned %d' % (url, response.status_code))
+    chunks = iter(response.response)
+    size = len(next(chunks, b''))
+    first_byte = time.perf_counter() - started
+    size += sum(len(chunk) for chunk in chunks)
+    elapsed = time.perf_counter() - started
+    response.close()
+    return first_byte, elapsed, size
+
+
+def bench_export(sizes, formats):
+    # the admin export of every activity; peak allocations are measured in a second
+    # pass because tracemalloc slows the first one down
+    import app as bucket_list
+    flask_app = bucket_list.app
+    admin = generate_user(0)['username']
+    results = []
+    for size in sizes:
+        seed_app_data(bucket_list.db, size)
+        client = logged_in_client(flask_app, admin)
+        for fmt in formats:
+            url = '/activities/activities/export?format=' + fmt
+            first_byte, elapsed, streamed = stream_export(client, url)
+            tracemalloc.start()
+            stream_export(client, url)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results.append({'name': 'export/' + fmt, 'size': size, 'first_byte_ms': first_byte * 1000,
+                            'total_ms': elapsed * 1000, 'bytes': streamed, 'peak_alloc_bytes': peak})
+    for result in results:
+        print('{name:<16} size={size:<9} first byte={first_byte_ms:9.2f}ms  total={total_ms:10.2f}ms  '
+              'streamed={bytes:>14,} B  peak alloc={peak_alloc_bytes:>12,} B'.format(**result))
+    return results
+
+
+########## autocomplete ##########
+def autocomplete_activities(count, seed=0):
+    # distinct public activity names, so the index holds about count entries
+    rng = random.Random(seed)
+    for i in range(count):
+        category = rng.choice(CATEGORIES)
+        city, state, country = rng.choice(PLACES)
+        yield {'activity_name': '%s in %s %d' % (rng.choice(ACTIVITIES[category]), city, i),
+               'category': category, 'city': city, 'share_status': 'Public'}
+
+
+def bench_autocomplete(sizes, lookups):
+    # build time, memory and lookup latency of the in-memory index, without Mongo
+    results = []
+    rng = random.Random(1)
+    alphabet = 'abcdefghijklmnopqrstuvwxyz'
+    for size in sizes:
+        index = PrefixIndex()
+        started = time.perf_counter()
+        index.load(e for activity in autocomplete_activities(size) for e in activity_entries(activity))
+        build = time.perf_counter() - started
+        index_stats = index.stats()
+        prefixes = [(''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))),) for _ in range(lookups)]
+        result = summarize('autocomplete', time_calls(index.lookup, prefixes, 1))
+        result.update({'size': size, 'entries': index_stats['entries'], 'bytes': index_stats['bytes'],
+                       'build_s': build})
+        results.append(result)
+        print('autocomplete size={size:<9} entries={entries:<9} build={build_s:7.2f}s  '
+              'index={bytes:>13,} B'.format(**result))
+    return results
+
+
+########## bulk operations ##########
+def one_at_a_time(collection, selected, changes=None):
+    # what the single-item admin routes do for each selected activity
+    for value in selected:
+        doc = collection.find_one({'_id': object_id(value)})
+        if changes:
+            collection.update_one({'_id': doc['_id']}, bulk.modified(changes))
+        else:
+            collection.delete_one({'_id': doc['_id']})
+
+
+def bench_bulk(db, size, counts):
+    # items/sec of each admin bulk action against the same work one item at a time
+    collection = db['bucketList']
+    seed_activities(collection, size)
+    ids = [str(doc['_id']) for doc in collection.find({}, {'_id': 1})]
+    results = []
+    offset = 0
+    for count in counts:
+        for action, changes in [('share_status', {'share_status': 'Private'}), ('category', {'category': 'Other'}),
+                                ('delete', None)]:
+            for variant in ('single', 'bulk'):
+                selected = ids[offset:offset + count]
+                offset += count
+                started = time.perf_counter()
+                if variant == 'single':
+                    one_at_a_time(collection, selected, changes)
+                elif changes:
+                    bulk.set_fields(collection, selected, changes, 'activity_name')
+                else:
+                    bulk.delete(collection, selected, 'activity_name')
+                elapsed = time.perf_counter() - started
+                results.append({'name': 'bulk/%s/%s' % (action, variant), 'size': count,
+                                'total_ms': elapsed * 1000, 'per_sec': count / elapsed})
+    for result in results:
+        print('{name:<28} items={size:<7} total={total_ms:10.2f}ms {per_sec:10.1f}/sec'.format(**result))
+    return results
+
+
+########## related activities ##########
+def bench_related(sizes, lookups, champions, top_k):
+    # batch rebuild (model, then every activity's top k) and the incremental
+    # lookup done when an activity is saved, without Mongo
+    if not related.available():
+        sys.exit('the related benchmark needs numpy and scipy: pip install numpy scipy')
+    results = []
+    rng = random.Random(1)
+    for size in sizes:
+        activities = [dict(activity, _id=ObjectId()) for activity in generate_activities(size)]
+        started = time.perf_counter()
+        computed = related.compute(iter(activities), champions, top_k)
+        model, _ = next(computed)
+        build = time.perf_counter() - started
+        started = time.perf_counter()
+        for _ in computed:
+            pass
+        top = time.perf_counter() - started
+        sample = [(model.vectors([activity]), [model.position(activity['_id'])], top_k * 2)
+                  for activity in rng.sample(activities, min(lookups, size))]
+        result = summarize('related/incremental', time_calls(model.neighbours, sample, 1))
+        result.update({'size': size, 'build_s': build, 'top_k_s': top, 'terms': len(model.vocab),
+                       'champion_nnz': model.champions.nnz})
+        results.append(result)
+        print('related size={size:<9} terms={terms:<7} champions={champion_nnz:<10} model={build_s:7.2f}s  '
+              'top {k} for all={top_k_s:8.2f}s'.format(k=top_k, **result))
+    return results
+
+
+########## projections ##########
+def measure_fetch(collection, projection, materialize, rows):
+    # wire bytes of the raw BSON batches, then time and peak allocations to build the rows
+    wire_bytes = sum(len(batch) for batch in collection.find_raw_batches({}, projection).limit(rows))
+    tracemalloc.start()
+    started = time.perf_counter()
+    materialized = materialize(collection.find({}, projection).limit(rows))
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del materialized
+    return wire_bytes, elapsed, peak
+
+
+def bench_projection(db, size, rows):
+    # full documents as the list pages used to fetch them against projected compact rows
+    seed_app_data(db, size)
+    shapes = [
+        ('activities', db['bucketList'], ActivityRow),
+        ('users', db['users'], UserRow),
+    ]
+    results = []
+    for name, collection, row_type in shapes:
+        for variant, projection, materialize in [('full', None, list),
+                                                 ('projected', row_type.projection(), row_type.from_docs)]:
+            wire_bytes, elapsed, peak = measure_fetch(collection, projection, materialize, rows)
+            results.append({'name': '%s/%s' % (name, variant), 'size': size, 'rows': rows,
+                            'wire_bytes': wire_bytes, 'fetch_ms': elapsed * 1000, 'peak_alloc_bytes': peak})
+    for result in results:
+        print('{name:<22} size={size:<9} rows={rows:<7} wire={wire_bytes:>12,} B  fetch={fetch_ms:9.2f}ms  '
+              'peak alloc={peak_alloc_bytes:>12,} B'.format(**result))
+    return results
+
+
+########## output ##########
+def write_results(path, results, command):
+    with open(path, 'w') as f:
+        json.dump({
+            'command': command,
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'results': results,
+        }, f, indent=2)
+
+
+def compare_results(path, results, threshold):
+    # returns the results whose p95 is more than threshold times the baseline's
+    with open(path) as f:
+        baseline = {(r['name'], str(r['size'])): r for r in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        before = baseline.get((result['name'], str(result['size'])))
+        if before and 'p95_ms' in result and result['p95_ms'] > before['p95_ms'] * threshold:
+            regressions.append((result, before))
+    return regressions
+
+
+def print_results(results):
+    for result in results:
+        line = '{name:<28} size={size:<9} n={count:<5} p50={p50_ms:8.2f}ms p95={p95_ms:8.2f}ms p99={p99_ms:8.2f}ms'.format(**result)
+        if 'per_sec' in result:
+            line += ' {:8.1f}/sec'.format(result['per_sec'])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bucket list benchmarks')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='exit with an error if p95 regressed against this earlier --output file')
+    parser.add_argument('--threshold', type=float, default=1.25, help='allowed p95 ratio against --compare (default 1.25)')
+    parser.add_argument('--mongomock', action='store_true', help='run against an in-memory mongomock stand-in')
+    subparsers = parser.add_subparsers(dest='command')
+
+    search_parser = subparsers.add_parser('search', help='ranked text search latency')
+    search_parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    search_parser.add_argument('--repeat', type=int, default=20)
+
+    passwords_parser = subparsers.add_parser('passwords', help='bcrypt login throughput per worker')
+    passwords_parser.add_argument('--rounds', type=int, nargs='+', default=[4, 8, 10, 12])
+    passwords_parser.add_argument('--logins', type=int, default=50)
+    passwords_parser.add_argument('--threads', type=int, default=8, help='request threads per worker')
+
+    routes_parser = subparsers.add_parser('routes', help='p50/p95/p99 and throughput of the main pages through the Flask app')
+    routes_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    routes_parser.add_argument('--requests', type=int, default=100, help='requests per route and size')
+
+    near_parser = subparsers.add_parser('near', help='activities near a point by radius, sorted by distance')
+    near_parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    near_parser.add_argument('--radii', type=float, nargs='+', default=[50, 500, 5000], help='km')
+    near_parser.add_argument('--repeat', type=int, default=5)
+
+    export_parser = subparsers.add_parser('export', help='time to first byte, duration and peak memory of streamed exports')
+    export_parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    export_parser.add_argument('--formats', nargs='+', choices=['ndjson', 'csv'], default=['ndjson', 'csv'])
+
+    autocomplete_parser = subparsers.add_parser('autocomplete', help='build time, memory and prefix lookup latency of the autocomplete index')
+    autocomplete_parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    autocomplete_parser.add_argument('--lookups', type=int, default=10000, help='random 1-4 letter prefixes per size')
+
+    bulk_parser = subparsers.add_parser('bulk', help='throughput of the admin bulk actions against one item at a time')
+    bulk_parser.add_argument('--size', type=int, default=100000, help='activities seeded')
+    bulk_parser.add_argument('--counts', type=int, nargs='+', default=[100, 1000, 5000], help='items selected per action')
+
+    related_parser = subparsers.add_parser('related', help='batch rebuild time and incremental lookup latency of related activities')
+    related_parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    related_parser.add_argument('--lookups', type=int, default=1000, help='activities scored one at a time per size')
+    related_parser.add_argument('--champions', type=int, default=related.CHAMPIONS)
+    related_parser.add_argument('--top-k', type=int, default=related.TOP_K)
+
+    projection_parser = subparsers.add_parser('projection', help='wire bytes and allocations of full documents vs list projections')
+    projection_parser.add_argument('--size', type=int, default=100000)
+    projection_parser.add_argument('--rows', type=int, default=10000, help='rows fetched per list')
+
+    args = parser.parse_args()
+    os.environ['MONGO_DB'] = BENCH_DB
+    if args.mongomock:
+        use_mongomock()
+
+    if args.command == 'search':
+        results = bench_search(get_db(), args.sizes, args.repeat)
+    elif args.command == 'near':
+        results = bench_near(get_db(), args.sizes, args.radii, args.repeat)
+    elif args.command == 'passwords':
+        results = bench_passwords(args.rounds, args.logins, args.threads)
+    elif args.command == 'routes':
+        results = bench_routes(args.sizes, args.requests, skip_search=args.mongomock)
+    elif args.command == 'projection':
+        results = bench_projection(get_db(), args.size, args.rows)
+    elif args.command == 'export':
+        results = bench_export(args.sizes, args.formats)
+    elif args.command == 'bulk':
+        results = bench_bulk(get_db(), args.size, args.counts)
+    elif args.command == 'autocomplete':
+        results = bench_autocomplete(args.sizes, args.lookups)
+    elif args.command == 'related':
+        results = bench_related(args.sizes, args.lookups, args.champions, args.top_k)
+    else:
+        parser.print_help()
+        return
+
+    if args.command not in ('projection', 'export', 'bulk'):
+        print_results(results)
+    if args.output:
+        write_results(args.output, results, args.command)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        for result, before in regressions:
+            print('REGRESSION {} size={}: p95 {:.2f}ms -> {:.2f}ms'.format(
+                result['name'], result['size'], before['p95_ms'], result['p95_ms']))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
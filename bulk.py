@@ -0,0 +1,151 @@
+import datetime
+import time
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from repository import object_id
+
+# Admin actions on many selected activities or users at once. An action reads the
+# selected documents with one $in query, writes them all with one unordered
+# bulk_write, and reports what happened to each one: done, unchanged, not found,
+# changed by someone else, or the server's error for that write.
+#
+# Every write only matches the document as it was read, as in migrate.py, and
+# stamps it with a new version and date_modified. A document counts as done only
+# once the server confirms the write: from the write counts when every write
+# matched, otherwise by reading back which documents carry the stamp. A delete
+# first stamps its documents that way, then deletes the stamped ones, so a
+# document deleted by someone else meanwhile is never counted twice.
+
+DONE = 'done'
+UNCHANGED = 'unchanged'
+NOT_FOUND = 'not found'
+INVALID = 'invalid id'
+CHANGED = 'changed by someone else'
+
+
+class BulkResult:
+    def __init__(self):
+        self.items = []         # (id, label, outcome) in the order they were selected
+        self.changes = []       # (before, after) of every document written; after is None for a delete
+        self.seconds = 0.0
+
+    def counts(self):
+        counts = {}
+        for _id, label, outcome in self.items:
+            counts[outcome] = counts.get(outcome, 0) + 1
+        return counts
+
+    def per_second(self):
+        return len(self.items) / self.seconds if self.seconds else 0.0
+
+    def set_outcome(self, position, outcome):
+        value, label, _ = self.items[position]
+        self.items[position] = (value, label, outcome)
+
+
+def write(collection, writes, count):
+    # (per-write errors by index, how many writes the server applied)
+    try:
+        result = collection.bulk_write(writes, ordered=False)
+    except BulkWriteError as e:
+        errors = {error['index']: error.get('errmsg', 'write failed') for error in e.details['writeErrors']}
+        return errors, e.details[count]
+    return {}, result.bulk_api_result[count]
+
+
+def stamped(collection, pending, now):
+    # the pending (position, doc, after) whose write is confirmed to have applied
+    ids = [doc['_id'] for position, doc, after in pending]
+    current = {doc['_id']: doc for doc in collection.find({'_id': {'$in': ids}}, {'version': 1, 'date_modified': 1})}
+    return [(position, doc, after) for position, doc, after in pending
+            if doc['_id'] in current and current[doc['_id']].get('version') == (doc.get('version') or 0) + 1
+            and current[doc['_id']].get('date_modified') == now]
+
+
+def run_bulk(collection, selected, changes, label_field, projection=None):
+    # changes is the $set for every selected document, or None to delete them
+    result = BulkResult()
+    started = time.perf_counter()
+    if projection:
+        projection = dict(projection, version=1)
+    # a row ticked twice, or the same id spelled two ways, is written and counted once
+    ids = []
+    seen = set()
+    for value in dict.fromkeys(selected):
+        _id = object_id(value)
+        if _id is None or _id not in seen:
+            seen.add(_id)
+            ids.append((value, _id))
+    valid = [_id for value, _id in ids if _id is not None]
+    docs = {doc['_id']: doc for doc in collection.find({'_id': {'$in': valid}}, projection)} if valid else {}
+
+    pending = []
+    for value, _id in ids:
+        doc = docs.get(_id)
+        if _id is None:
+            result.items.append((value, value, INVALID))
+        elif doc is None:
+            result.items.append((value, value, NOT_FOUND))
+        elif changes and all(doc.get(field) == value for field, value in changes.items()):
+            result.items.append((value, doc.get(label_field), UNCHANGED))
+        else:
+            pending.append((len(result.items), doc, dict(doc, **changes) if changes else None))
+            result.items.append((value, doc.get(label_field), DONE))
+
+    # Mongo keeps dates to the millisecond, and the stamp is compared on read back
+    now = datetime.datetime.now()
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    if pending:
+        # a missing field matches None, so every field read goes in the filter as is
+        errors, matched = write(collection, [UpdateOne(doc, modified(changes or {}, now))
+                                             for position, doc, after in pending], 'nMatched')
+        for index, (position, doc, after) in enumerate(pending):
+            if index in errors:
+                result.set_outcome(position, errors[index])
+        pending = [item for index, item in enumerate(pending) if index not in errors]
+        if matched < len(pending):
+            confirmed = stamped(collection, pending, now)
+            positions = {position for position, doc, after in confirmed}
+            for position, doc, after in pending:
+                if position not in positions:
+                    result.set_outcome(position, CHANGED)
+            pending = confirmed
+
+    if pending and changes is None:
+        errors, deleted = write(collection, [DeleteOne({'_id': doc['_id'], 'version': (doc.get('version') or 0) + 1,
+                                                        'date_modified': now})
+                                             for position, doc, after in pending], 'nRemoved')
+        for index, (position, doc, after) in enumerate(pending):
+            if index in errors:
+                result.set_outcome(position, errors[index])
+        pending = [item for index, item in enumerate(pending) if index not in errors]
+        if deleted < len(pending):
+            # some were changed or deleted by someone else since they were stamped. The
+            # ones gone were deleted here only if they account for every delete; when
+            # they don't, none of them is counted, and a statistics rebuild settles it
+            left = {doc['_id'] for doc in collection.find(
+                {'_id': {'$in': [doc['_id'] for position, doc, after in pending]}}, {'_id': 1})}
+            gone = [item for item in pending if item[1]['_id'] not in left]
+            if len(gone) != deleted:
+                gone = []
+            positions = {position for position, doc, after in gone}
+            for position, doc, after in pending:
+                if position not in positions:
+                    result.set_outcome(position, CHANGED)
+            pending = gone
+
+    result.changes = [(doc, after) for position, doc, after in pending]
+    result.seconds = time.perf_counter() - started
+    return result
+
+
+def modified(changes, now=None):
+    return {'$set': dict(changes, date_modified=now or datetime.datetime.now()), '$inc': {'version': 1}}
+
+
+def set_fields(collection, selected, changes, label_field, projection=None):
+    return run_bulk(collection, selected, changes, label_field, projection)
+
+
+def delete(collection, selected, label_field, projection=None):
+    return run_bulk(collection, selected, None, label_field, projection)
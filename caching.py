@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+
+
+class TTLCache:
+    # bounded least-recently-used cache whose entries also expire after ttl seconds
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def pop_matching(self, predicate):
+        with self._lock:
+            for key in [key for key, (value, expires) in self._data.items() if predicate(value)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class ReferenceData:
+    # small lookup collections (categories, share statuses, roles) held in memory as
+    # immutable tuples; version goes up every time any of them is reloaded
+    def __init__(self, collections, max_age=300):
+        self.collections = collections
+        self.max_age = max_age
+        self.version = 0
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        entry = self._data.get(name)
+        if entry is None or entry[1] <= time.monotonic():
+            return self.refresh(name)
+        return entry[0]
+
+    def refresh(self, name):
+        rows = tuple(MappingProxyType(doc) for doc in self.collections[name].find())
+        with self._lock:
+            self._data[name] = (rows, time.monotonic() + self.max_age)
+            self.version += 1
+        return rows
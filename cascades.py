@@ -0,0 +1,73 @@
+import datetime
+import functools
+import stats
+from conditional import bump_version
+
+# Activities name their category and user as plain strings, so renaming or deleting
+# a category, or deleting a user, has to reach every activity that names it. These
+# handlers run as background jobs (see jobs.py). They work in batches of
+# BATCH_SIZE activities, each one update_many or delete_many plus one bulk_write
+# for the statistics. Every batch selects from the activities still to do, so an
+# interrupted job just carries on when it runs again.
+
+BATCH_SIZE = 1000
+
+# where the activities of a deleted category go
+UNCATEGORIZED = 'Other'
+
+
+def pending(bucketList, query, batch_size):
+    return list(bucketList.find(query, {field: 1 for field in stats.FIELDS}).limit(batch_size))
+
+
+def move_activities(bucketList, activity_stats, counters, query, changes, report, batch_size=BATCH_SIZE):
+    report(remaining=bucketList.count_documents(query))
+    docs = pending(bucketList, query, batch_size)
+    while docs:
+        # the query stays in the filter so an activity edited since it was read is left alone
+        bucketList.update_many(dict(query, _id={'$in': [doc['_id'] for doc in docs]}),
+                               {'$set': dict(changes, date_modified=datetime.datetime.now()), '$inc': {'version': 1}})
+        stats.apply_changes(activity_stats, [(doc, dict(doc, **changes)) for doc in docs])
+        bump_version(counters, 'bucketList')
+        report(len(docs))
+        docs = pending(bucketList, query, batch_size)
+
+
+def delete_activities(bucketList, activity_stats, counters, query, report, batch_size=BATCH_SIZE):
+    report(remaining=bucketList.count_documents(query))
+    docs = pending(bucketList, query, batch_size)
+    while docs:
+        bucketList.delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+        stats.apply_changes(activity_stats, [(doc, None) for doc in docs])
+        bump_version(counters, 'bucketList')
+        report(len(docs))
+        docs = pending(bucketList, query, batch_size)
+
+
+def rename_category(bucketList, activity_stats, counters, params, report):
+    if params['old'] != params['new']:
+        move_activities(bucketList, activity_stats, counters, {'category': params['old']},
+                        {'category': params['new']}, report)
+
+
+def delete_category(bucketList, activity_stats, counters, params, report):
+    # activities already in the replacement would still match, so they'd be moved forever
+    replacement = params.get('replacement') or UNCATEGORIZED
+    if params['name'] != replacement:
+        move_activities(bucketList, activity_stats, counters, {'category': params['name']},
+                        {'category': replacement}, report)
+
+
+def delete_user(bucketList, activity_stats, counters, params, report):
+    # only activities from before the delete, in case the username is taken again meanwhile
+    usernames = params.get('usernames') or [params['username']]
+    query = {'username': {'$in': usernames}, 'date_added': {'$lte': params['deleted']}}
+    delete_activities(bucketList, activity_stats, counters, query, report)
+
+
+def handlers(bucketList, activity_stats, counters):
+    # job kind -> handler(params, report), for JobRunner
+    return {kind: functools.partial(handler, bucketList, activity_stats, counters)
+            for kind, handler in (('rename_category', rename_category),
+                                  ('delete_category', delete_category),
+                                  ('delete_user', delete_user))}
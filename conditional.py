@@ -0,0 +1,74 @@
+import datetime
+import hashlib
+import os
+from flask import request, session, make_response
+from pymongo import ReturnDocument
+
+# Conditional GET support. A single activity is validated by its own date_modified;
+# listings are validated by a per-collection change counter kept in the counters
+# collection, which every write to the collection bumps.
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), 'templates')
+
+
+def templates_stamp():
+    # a deploy that changes a template must not be answered with 304s for the old markup
+    return str(max(os.path.getmtime(os.path.join(TEMPLATES, name)) for name in os.listdir(TEMPLATES)))
+
+
+TEMPLATES_STAMP = templates_stamp()
+
+
+def bump_version(counters, name):
+    return counters.find_one_and_update(
+        {'_id': name},
+        {'$inc': {'version': 1}, '$set': {'date_modified': datetime.datetime.now()}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER)
+
+
+def collection_version(counters, name):
+    # (version, date_modified) of a collection; (0, None) until its first write
+    counter = counters.find_one({'_id': name}) or {}
+    return counter.get('version', 0), counter.get('date_modified')
+
+
+def make_etag(*parts):
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def page_etag(version, username):
+    # the rendered page also depends on who is looking at it and on the query string
+    return make_etag(TEMPLATES_STAMP, version, username or '', request.full_path)
+
+
+def is_not_modified(etag, last_modified=None):
+    # pages with flash messages waiting always render, otherwise the message would be lost
+    if request.method != 'GET' or session.get('_flashes'):
+        return False
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified and request.if_modified_since:
+        return request.if_modified_since >= last_modified.replace(microsecond=0)
+    return False
+
+
+def set_validators(response, etag, last_modified=None):
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    # browsers may keep the page but must revalidate it before every use
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+def with_validators(response, etag, last_modified=None):
+    response = make_response(response)
+    if response.status_code == 200:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    return set_validators(make_response('', 304), etag, last_modified)
@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pymongo
+from pymongo import WriteConcern
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from metrics import QueryListener
+
+# Mongo client settings come from the environment, and the client itself is only
+# created the first time a process uses it. pymongo clients are not fork safe, so a
+# prefork server that imports the app in its master must not hand the master's
+# client to its workers: each process that touches the database gets its own.
+
+# MongoClient option -> environment variable, all integers
+INT_OPTIONS = [
+    ('maxPoolSize', 'MONGO_MAX_POOL_SIZE'),
+    ('minPoolSize', 'MONGO_MIN_POOL_SIZE'),
+    ('maxIdleTimeMS', 'MONGO_MAX_IDLE_TIME_MS'),
+    ('waitQueueTimeoutMS', 'MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+    ('connectTimeoutMS', 'MONGO_CONNECT_TIMEOUT_MS'),
+    ('socketTimeoutMS', 'MONGO_SOCKET_TIMEOUT_MS'),
+    ('serverSelectionTimeoutMS', 'MONGO_SERVER_SELECTION_TIMEOUT_MS'),
+    ('zlibCompressionLevel', 'MONGO_ZLIB_COMPRESSION_LEVEL'),
+]
+
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+def write_concern_value(value):
+    # MONGO_W=majority or MONGO_W=1
+    return int(value) if value.isdigit() else value
+
+
+def env_flag(name):
+    return os.getenv(name, '').lower() in ('1', 'true', 'yes')
+
+
+def client_options():
+    options = {'event_listeners': [QueryListener()],
+               'appname': os.getenv('MONGO_APPNAME', 'bucket_list')}
+    for option, name in INT_OPTIONS:
+        if os.getenv(name):
+            options[option] = int(os.getenv(name))
+    # e.g. 'zstd,snappy,zlib'; pymongo skips any whose library isn't installed
+    if os.getenv('MONGO_COMPRESSORS'):
+        options['compressors'] = os.getenv('MONGO_COMPRESSORS')
+    # the default write concern for every write the app makes
+    if os.getenv('MONGO_W'):
+        options['w'] = write_concern_value(os.getenv('MONGO_W'))
+    if os.getenv('MONGO_JOURNAL'):
+        options['journal'] = env_flag('MONGO_JOURNAL')
+    if os.getenv('MONGO_WTIMEOUT_MS'):
+        options['wTimeoutMS'] = int(os.getenv('MONGO_WTIMEOUT_MS'))
+    return options
+
+
+def public_read_preference():
+    # the read preference for the public listing, search and near pages, which can
+    # tolerate data a little behind the primary; None keeps the client default
+    name = os.getenv('MONGO_PUBLIC_READ_PREFERENCE')
+    if not name or name == 'primary':
+        return None
+    staleness = int(os.getenv('MONGO_PUBLIC_MAX_STALENESS_SECONDS', -1))
+    return READ_PREFERENCES[name](max_staleness=staleness)
+
+
+def derived_write_concern():
+    # statistics rollups can always be rebuilt from bucketList, so they don't have
+    # to wait for the same acknowledgement as the activities themselves
+    return WriteConcern(w=write_concern_value(os.getenv('MONGO_DERIVED_W', '1')))
+
+
+class LazyClient:
+    def __init__(self, uri=None, **options):
+        self.uri = uri
+        self.options = options
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    # a client inherited over fork is dropped, not closed, since its
+                    # sockets and monitor threads belong to the parent
+                    self._client = pymongo.MongoClient(self.uri, **self.options)
+                    self._pid = pid
+        return self._client
+
+    def warmup(self, connections=1):
+        # opens connections now so the first requests don't pay for the handshakes;
+        # concurrent pings each need their own pooled connection
+        started = time.perf_counter()
+        client = self.get()
+        with ThreadPoolExecutor(max_workers=max(1, connections)) as pool:
+            list(pool.map(lambda _: client.admin.command('ping'), range(max(1, connections))))
+        return time.perf_counter() - started
+
+
+class LazyDatabase:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def get(self):
+        return self.client.get()[self.name]
+
+    def __getitem__(self, name):
+        return LazyCollection(self, name)
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+
+class LazyCollection:
+    # stands in for a pymongo Collection and forwards everything to the real one
+    # belonging to the current process
+    def __init__(self, database, name, **options):
+        self._database = database
+        self._name = name
+        self._options = options
+        self._collection = None
+        self._client = None
+
+    def get(self):
+        client = self._database.client.get()
+        if self._client is not client:
+            collection = client[self._database.name][self._name]
+            self._collection = collection.with_options(**self._options) if self._options else collection
+            self._client = client
+        return self._collection
+
+    def with_options(self, **options):
+        return LazyCollection(self._database, self._name, **dict(self._options, **options))
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
@@ -0,0 +1,145 @@
+import datetime
+import random
+import sys
+import time
+from pymongo.errors import BulkWriteError
+from geocode import geocode_activity
+
+FIRST_NAMES = ['Marcus', 'Ana', 'Kenji', 'Priya', 'Liam', 'Sofia', 'Mateo', 'Amara', 'Noah', 'Elena',
+               'Omar', 'Hana', 'Lucas', 'Zara', 'Ethan', 'Mei', 'Diego', 'Aisha', 'Jonas', 'Chloe']
+LAST_NAMES = ['Porter', 'Silva', 'Tanaka', 'Patel', 'Murphy', 'Rossi', 'Garcia', 'Okafor', 'Smith', 'Novak',
+              'Haddad', 'Kim', 'Martin', 'Khan', 'Brown', 'Chen', 'Lopez', 'Mensah', 'Berg', 'Dubois']
+
+CATEGORIES = ['Historic location', 'Adrenaline rush', 'Nature', 'Event', 'Other']
+
+# (city, state, country)
+PLACES = [
+    ('Glenwood Springs', 'Colorado', 'United States of America'),
+    ('Moab', 'Utah', 'United States of America'),
+    ('New Orleans', 'Louisiana', 'United States of America'),
+    ('Anchorage', 'Alaska', 'United States of America'),
+    ('Honolulu', 'Hawaii', 'United States of America'),
+    ('New York', 'New York', 'United States of America'),
+    ('Banff', 'Alberta', 'Canada'),
+    ('Quebec City', 'Quebec', 'Canada'),
+    ('Cancun', 'Quintana Roo', 'Mexico'),
+    ('Cusco', 'Cusco', 'Peru'),
+    ('Rio de Janeiro', 'Rio de Janeiro', 'Brazil'),
+    ('Reykjavik', 'Capital Region', 'Iceland'),
+    ('Edinburgh', 'Scotland', 'United Kingdom'),
+    ('London', 'England', 'United Kingdom'),
+    ('Paris', 'Ile-de-France', 'France'),
+    ('Rome', 'Lazio', 'Italy'),
+    ('Barcelona', 'Catalonia', 'Spain'),
+    ('Interlaken', 'Bern', 'Switzerland'),
+    ('Cairo', 'Cairo', 'Egypt'),
+    ('Cape Town', 'Western Cape', 'South Africa'),
+    ('Nairobi', 'Nairobi', 'Kenya'),
+    ('Kyoto', 'Kyoto', 'Japan'),
+    ('Tokyo', 'Tokyo', 'Japan'),
+    ('Siem Reap', 'Siem Reap', 'Cambodia'),
+    ('Bali', 'Bali', 'Indonesia'),
+    ('Queenstown', 'Otago', 'New Zealand'),
+    ('Sydney', 'New South Wales', 'Australia'),
+    ('Cairns', 'Queensland', 'Australia'),
+]
+
+# activity name templates by category
+ACTIVITIES = {
+    'Historic location': ['visit the old town', 'tour the castle', 'walk the ancient ruins', 'see the cathedral',
+                          'explore the museum', 'climb the lighthouse'],
+    'Adrenaline rush': ['skydiving', 'bungee jumping', 'white water rafting', 'paragliding', 'scuba diving',
+                        'zip lining', 'shark cage diving'],
+    'Nature': ['hike to the waterfall', 'watch the northern lights', 'camp under the stars', 'whale watching',
+               'snorkel the reef', 'hot air balloon ride', 'visit the hot springs'],
+    'Event': ['see a live concert', 'run the marathon', 'go to the carnival', 'attend the food festival',
+              'watch the fireworks', 'see the opera'],
+    'Other': ['learn to cook the local food', 'take a road trip', 'learn to surf', 'ride a night train',
+              'stay in a treehouse'],
+}
+DESCRIPTION_WORDS = ['amazing', 'with friends', 'solo', 'at sunrise', 'at sunset', 'in the summer', 'in the winter',
+                     'once in a lifetime', 'finally', 'with family', 'guided', 'for my birthday', 'on a budget']
+STREETS = ['Main St', 'Airport Center Rd', 'Harbour Rd', 'Station Rd', 'Market St', 'Park Ave', 'Old Town Sq']
+
+
+def generate_user(n, seed=0, password=''):
+    # each user gets its own random stream so activities can look up user n's
+    # username without generating or holding every user
+    rng = random.Random('%d-%d' % (seed, n))
+    first_name = rng.choice(FIRST_NAMES)
+    last_name = rng.choice(LAST_NAMES)
+    username = '%s%s%d' % (first_name.lower(), last_name.lower(), n)
+    date_added = datetime.datetime(2020, 1, 1) + datetime.timedelta(minutes=n)
+    return {
+        'first_name': first_name,
+        'last_name': last_name,
+        'username': username,
+        'email': username + '@example.com',
+        'password': password,
+        'role': 'admin' if n == 0 else 'contributor',
+        'date_added': date_added,
+        'date_modified': date_added,
+    }
+
+
+def generate_users(count, seed=0, password=''):
+    # password should already be hashed; every generated user shares it
+    for n in range(count):
+        yield generate_user(n, seed, password)
+
+
+def generate_activities(count, users=1000, seed=0):
+    rng = random.Random(seed)
+    start = datetime.datetime(2020, 1, 1)
+    for i in range(count):
+        category = rng.choice(CATEGORIES)
+        city, state, country = rng.choice(PLACES)
+        name = rng.choice(ACTIVITIES[category])
+        date_added = start + datetime.timedelta(seconds=i * 7)
+        expected = date_added + datetime.timedelta(days=rng.randint(30, 1500))
+        yield geocode_activity({
+            'activity_name': '%s in %s' % (name, city),
+            'category': category,
+            'description': '%s %s, %s' % (name, ' '.join(rng.sample(DESCRIPTION_WORDS, 2)), country),
+            'share_status': 'Public' if rng.random() < 0.7 else 'Private',
+            'estimated_cost': 100 * rng.choice([0, 20, 50, 75, 150, 300, 500, 1200, 3000, 8000]),
+            'address': '%d %s' % (rng.randint(1, 9999), rng.choice(STREETS)),
+            'city': city,
+            'state': state,
+            'country': country,
+            'expected_date': datetime.datetime(expected.year, expected.month, expected.day),
+            'username': generate_user(rng.randrange(users), seed)['username'],
+            'date_added': date_added,
+            'date_modified': date_added,
+        })
+
+
+def insert_batches(collection, docs, batch_size=1000, label='documents', progress=True):
+    # insert_many(ordered=False) in fixed-size batches; duplicates and other write errors
+    # are counted and skipped instead of aborting the load
+    inserted = errors = 0
+    started = time.perf_counter()
+    batch = []
+
+    def flush():
+        nonlocal inserted, errors
+        try:
+            inserted += len(collection.insert_many(batch, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            inserted += e.details['nInserted']
+            errors += len(e.details['writeErrors'])
+        if progress:
+            rate = inserted / max(time.perf_counter() - started, 1e-9)
+            sys.stderr.write('\r%s: %d inserted, %d errors (%.0f/sec)' % (label, inserted, errors, rate))
+            sys.stderr.flush()
+
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            flush()
+            batch = []
+    if batch:
+        flush()
+    if progress:
+        sys.stderr.write('\n')
+    return inserted, errors
@@ -0,0 +1,92 @@
+import csv
+import datetime
+import io
+import json
+from normalize import format_cost
+
+# Streams activities as NDJSON or CSV straight off a batched cursor. Rows are
+# written to a small buffer and flushed every CHUNK_ROWS rows, so memory stays the
+# same however many activities are exported. Both formats load back with
+# `initialize-database.py load activities`: NDJSON keeps costs as integer cents,
+# CSV writes them as dollar text.
+
+FIELDS = ('_id', 'activity_name', 'category', 'description', 'share_status', 'estimated_cost',
+          'address', 'city', 'state', 'country', 'expected_date', 'username', 'date_added', 'date_modified')
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+BATCH_SIZE = 1000
+CHUNK_ROWS = 500
+
+
+def export_format(value):
+    return value if value in FORMATS else 'ndjson'
+
+
+def export_filename(scope, fmt):
+    return 'bucket-list-%s-%s.%s' % (scope, datetime.date.today().isoformat(), fmt)
+
+
+def export_cursor(collection, query, sort=None):
+    cursor = collection.find(query, {field: 1 for field in FIELDS}, batch_size=BATCH_SIZE)
+    if sort:
+        cursor = cursor.sort(sort)
+    return cursor
+
+
+def plain_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)   # ObjectId
+
+
+def export_row(doc):
+    row = {field: plain_value(doc.get(field)) for field in FIELDS}
+    if isinstance(doc.get('expected_date'), datetime.datetime):
+        row['expected_date'] = doc['expected_date'].strftime('%Y-%m-%d')
+    return row
+
+
+def ndjson_lines(cursor):
+    for doc in cursor:
+        yield json.dumps(export_row(doc)) + '\n'
+
+
+def csv_lines(cursor):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    yield buffer.getvalue()
+    for doc in cursor:
+        buffer.seek(0)
+        buffer.truncate()
+        row = export_row(doc)
+        row['estimated_cost'] = format_cost(doc.get('estimated_cost'))
+        writer.writerow(['' if row[field] is None else row[field] for field in FIELDS])
+        yield buffer.getvalue()
+
+
+def chunks(lines):
+    # the first line goes out on its own so the response starts right away, then
+    # lines are sent CHUNK_ROWS at a time
+    buffer = []
+    flush_at = 1
+    for line in lines:
+        buffer.append(line)
+        if len(buffer) == flush_at:
+            yield ''.join(buffer)
+            buffer = []
+            flush_at = CHUNK_ROWS
+    if buffer:
+        yield ''.join(buffer)
+
+
+def export_chunks(cursor, fmt):
+    if fmt == 'csv':
+        return chunks(csv_lines(cursor))
+    return chunks(ndjson_lines(cursor))
@@ -0,0 +1,180 @@
+import csv
+import os
+import unicodedata
+
+# Offline geocoding against the bundled gazetteer in data/gazetteer.csv, which
+# holds city, region (state/province) and country centroids. An activity is placed
+# at the most specific match for its city/state/country; nothing is looked up over
+# the network. Locations are GeoJSON points, [longitude, latitude].
+
+GAZETTEER = os.path.join(os.path.dirname(__file__), 'data', 'gazetteer.csv')
+
+COUNTRY_ALIASES = {
+    'usa': 'united states of america',
+    'us': 'united states of america',
+    'united states': 'united states of america',
+    'america': 'united states of america',
+    'uk': 'united kingdom',
+    'great britain': 'united kingdom',
+    'britain': 'united kingdom',
+    'uae': 'united arab emirates',
+    'czechia': 'czech republic',
+    'korea': 'south korea',
+}
+
+US_STATES = {
+    'al': 'alabama', 'ak': 'alaska', 'az': 'arizona', 'ar': 'arkansas', 'ca': 'california',
+    'co': 'colorado', 'ct': 'connecticut', 'de': 'delaware', 'dc': 'district of columbia',
+    'fl': 'florida', 'ga': 'georgia', 'hi': 'hawaii', 'id': 'idaho', 'il': 'illinois',
+    'in': 'indiana', 'ia': 'iowa', 'ks': 'kansas', 'ky': 'kentucky', 'la': 'louisiana',
+    'me': 'maine', 'md': 'maryland', 'ma': 'massachusetts', 'mi': 'michigan', 'mn': 'minnesota',
+    'ms': 'mississippi', 'mo': 'missouri', 'mt': 'montana', 'ne': 'nebraska', 'nv': 'nevada',
+    'nh': 'new hampshire', 'nj': 'new jersey', 'nm': 'new mexico', 'ny': 'new york',
+    'nc': 'north carolina', 'nd': 'north dakota', 'oh': 'ohio', 'ok': 'oklahoma', 'or': 'oregon',
+    'pa': 'pennsylvania', 'ri': 'rhode island', 'sc': 'south carolina', 'sd': 'south dakota',
+    'tn': 'tennessee', 'tx': 'texas', 'ut': 'utah', 'vt': 'vermont', 'va': 'virginia',
+    'wa': 'washington', 'wv': 'west virginia', 'wi': 'wisconsin', 'wy': 'wyoming',
+}
+
+
+def normalize_name(value):
+    # 'Île-de-France ' -> 'ile-de-france'
+    value = value or ''
+    if not value.isascii():
+        value = unicodedata.normalize('NFKD', value)
+        value = ''.join(c for c in value if not unicodedata.combining(c))
+    return ' '.join(value.casefold().replace('.', '').split())
+
+
+def normalize_country(value):
+    country = normalize_name(value)
+    return COUNTRY_ALIASES.get(country, country)
+
+
+def normalize_region(value, country):
+    region = normalize_name(value)
+    if country == 'united states of america':
+        return US_STATES.get(region, region)
+    return region
+
+
+def point(longitude, latitude):
+    return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+
+class Gazetteer:
+    def __init__(self, path=GAZETTEER):
+        self.cities = {}     # (city, region, country) -> point
+        self.regions = {}    # (region, country) -> point
+        self.countries = {}  # country -> point
+        self.city_names = {} # city -> [(region, country)], for free text lookups
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                city = normalize_name(row['city'])
+                country = normalize_country(row['country'])
+                region = normalize_region(row['region'], country)
+                location = point(float(row['longitude']), float(row['latitude']))
+                if city:
+                    self.cities[city, region, country] = location
+                    self.city_names.setdefault(city, []).append((region, country))
+                elif region:
+                    self.regions[region, country] = location
+                else:
+                    self.countries[country] = location
+
+    def locate(self, city=None, region=None, country=None):
+        # (point, precision) for the most specific match, or (None, None)
+        country = normalize_country(country)
+        region = normalize_region(region, country)
+        city = normalize_name(city)
+        if city:
+            location = self.cities.get((city, region, country))
+            if location:
+                return location, 'city'
+            # the city is known in exactly one region of that country
+            matches = [key for key in self.city_names.get(city, ()) if key[1] == country]
+            if len(matches) == 1:
+                return self.cities[(city,) + matches[0]], 'city'
+        if region and (region, country) in self.regions:
+            return self.regions[region, country], 'region'
+        if country in self.countries:
+            return self.countries[country], 'country'
+        return None, None
+
+    def find_place(self, text):
+        # a point for free text such as 'Paris', 'Moab, UT' or 'Peru'
+        parts = [part for part in (text or '').split(',') if part.strip()]
+        if not parts:
+            return None
+        if len(parts) >= 3:
+            return self.locate(parts[0], parts[1], parts[-1])[0]
+        if len(parts) == 2:
+            # 'city, country', then 'city, US state', then 'region, country', then the country
+            for city, region, country, wanted in ((parts[0], None, parts[1], 'city'),
+                                                  (parts[0], parts[1], 'usa', 'city'),
+                                                  (None, parts[0], parts[1], 'region')):
+                location, precision = self.locate(city, region, country)
+                if precision == wanted:
+                    return location
+            return self.locate(None, None, parts[1])[0]
+        name = normalize_name(parts[0])
+        if name in self.city_names:
+            region, country = self.city_names[name][0]
+            return self.cities[name, region, country]
+        country = normalize_country(name)
+        if country in self.countries:
+            return self.countries[country]
+        for (region, country), location in self.regions.items():
+            if region == normalize_region(name, country):
+                return location
+        return None
+
+
+gazetteer = Gazetteer()
+
+
+def geocode_activity(activity):
+    # sets location and location_precision in place from city/state/country and
+    # returns the activity; location is None when nothing in the gazetteer matches
+    location, precision = gazetteer.locate(activity.get('city'), activity.get('state'), activity.get('country'))
+    # a fresh point per activity, never the gazetteer's own
+    activity['location'] = point(*location['coordinates']) if location else None
+    activity['location_precision'] = precision
+    return activity
+
+
+DEFAULT_RADIUS_KM = 100
+MAX_RADIUS_KM = 20000   # about half the earth's circumference
+
+
+def radius_km(value):
+    try:
+        radius = float(value)
+    except (TypeError, ValueError):
+        return DEFAULT_RADIUS_KM
+    return max(1, min(radius, MAX_RADIUS_KM))
+
+
+def request_point(args):
+    # the point a near query is centred on: lat/lon if given, otherwise the place name
+    try:
+        latitude, longitude = float(args.get('lat')), float(args.get('lon'))
+    except (TypeError, ValueError):
+        return gazetteer.find_place(args.get('place'))
+    if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+        return point(longitude, latitude)
+    return None
+
+
+def near_pipeline(location, radius, skip, limit, projection=None):
+    # public activities within radius km of location, nearest first, with the
+    # distance in metres; $geoNear has to be the first stage and uses the 2dsphere index
+    pipeline = [
+        {'$geoNear': {'near': location, 'distanceField': 'distance', 'spherical': True,
+                      'maxDistance': radius * 1000, 'query': {'share_status': 'Public'}}},
+        {'$skip': skip},
+        {'$limit': limit},
+    ]
+    if projection:
+        pipeline.append({'$project': projection})
+    return pipeline
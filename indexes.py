@@ -0,0 +1,159 @@
+import argparse
+import datetime
+import os
+import sys
+import pymongo
+from bson.objectid import ObjectId
+from dotenv import load_dotenv
+from search import text_index
+
+## necessary for python-dotenv ##
+APP_ROOT = os.path.join(os.path.dirname(__file__), '..')   # refers to application_top
+dotenv_path = os.path.join(APP_ROOT, '.env')
+load_dotenv(dotenv_path)
+
+ASC = pymongo.ASCENDING
+DESC = pymongo.DESCENDING
+
+# every index the application relies on, by collection
+INDEXES = {
+    'users': [
+        pymongo.IndexModel([('username', ASC)], unique=True, name='username_unique'),
+        pymongo.IndexModel([('email', ASC)], unique=True, name='email_unique'),
+    ],
+    'bucketList': [
+        # the cost and date range filters on the public listing are checked against the
+        # index keys, so non-matching activities are skipped without being fetched
+        pymongo.IndexModel([('share_status', ASC), ('date_added', DESC), ('_id', DESC),
+                            ('estimated_cost', ASC), ('expected_date', ASC)], name='share_status_date_added_cost_date'),
+        pymongo.IndexModel([('username', ASC), ('date_added', DESC), ('_id', DESC)], name='username_date_added'),
+        # a user's upcoming activities, soonest first
+        pymongo.IndexModel([('username', ASC), ('expected_date', ASC)], name='username_expected_date'),
+        pymongo.IndexModel([('category', ASC)], name='category'),
+        # activities near a point; share_status rides along so private ones are skipped in the index
+        pymongo.IndexModel([('location', pymongo.GEOSPHERE), ('share_status', ASC)], name='location_share_status'),
+        text_index(),
+    ],
+    'categories': [
+        pymongo.IndexModel([('category_name', ASC)], name='category_name'),
+    ],
+    'status': [
+        pymongo.IndexModel([('share_status', ASC)], name='share_status'),
+    ],
+    'roles': [
+        pymongo.IndexModel([('role_name', ASC)], name='role_name'),
+    ],
+    'jobs': [
+        pymongo.IndexModel([('status', ASC), ('date_added', ASC)], name='status_date_added'),
+    ],
+    'stats': [
+        pymongo.IndexModel([('dimension', ASC), ('count', DESC)], name='dimension_count'),
+    ],
+    'related': [
+        # the lists an activity appears in, to take it out when it changes
+        pymongo.IndexModel([('related._id', ASC)], name='related_id'),
+    ],
+}
+
+# indexes that have been superseded by one in INDEXES, by collection
+DROPPED_INDEXES = {
+    'bucketList': ['share_status_date_added'],
+}
+
+
+def ensure_indexes(db):
+    # create_indexes is a no-op for indexes that already exist with the same spec
+    for collection_name, indexes in INDEXES.items():
+        db[collection_name].create_indexes(indexes)
+    for collection_name, names in DROPPED_INDEXES.items():
+        existing = db[collection_name].index_information()
+        for name in names:
+            if name in existing:
+                db[collection_name].drop_index(name)
+
+
+SAMPLE_ID = ObjectId()
+SAMPLE_DATE = datetime.datetime(2021, 1, 1)
+
+
+def keyset_bound(op):
+    return {'$or': [{'date_added': {op: SAMPLE_DATE}},
+                    {'date_added': SAMPLE_DATE, '_id': {op: SAMPLE_ID}}]}
+
+
+# (collection, filter, sort) for every query the routes issue against a filter;
+# unfiltered reads of the small lookup collections are deliberately left out
+QUERY_SHAPES = [
+    ('users', {'username': 'someone'}, None),
+    ('users', {'email': 'someone@example.com'}, None),
+    ('users', {'_id': SAMPLE_ID}, None),
+    ('bucketList', {'_id': SAMPLE_ID}, None),
+    ('bucketList', {'share_status': 'Public'}, [('date_added', DESC), ('_id', DESC)]),
+    ('bucketList', {'$and': [{'share_status': 'Public'}, keyset_bound('$lt')]}, [('date_added', DESC), ('_id', DESC)]),
+    ('bucketList', {'$and': [{'share_status': 'Public'}, keyset_bound('$gt')]}, [('date_added', ASC), ('_id', ASC)]),
+    ('bucketList', {'share_status': 'Public', 'estimated_cost': {'$lte': 20000}}, [('date_added', DESC), ('_id', DESC)]),
+    ('bucketList', {'share_status': 'Public', 'expected_date': {'$gte': SAMPLE_DATE, '$lte': SAMPLE_DATE + datetime.timedelta(days=90)}},
+     [('date_added', DESC), ('_id', DESC)]),
+    ('bucketList', {'$text': {'$search': 'skydiving'}, 'share_status': 'Public'}, None),
+    ('bucketList', {'location': {'$nearSphere': {'$geometry': {'type': 'Point', 'coordinates': [-109.55, 38.57]},
+                                                 '$maxDistance': 100000}}, 'share_status': 'Public'}, None),
+    ('bucketList', {'username': 'someone'}, [('date_added', DESC), ('_id', DESC)]),
+    ('bucketList', {'$and': [{'username': 'someone'}, keyset_bound('$lt')]}, [('date_added', DESC), ('_id', DESC)]),
+    ('bucketList', {'username': 'someone', 'expected_date': {'$gte': SAMPLE_DATE}}, [('expected_date', ASC)]),
+    ('bucketList', {'category': 'Nature'}, None),
+    ('categories', {'_id': SAMPLE_ID}, None),
+    ('status', {'_id': SAMPLE_ID}, None),
+    ('status', {'share_status': 'Public'}, None),
+    ('stats', {'dimension': 'category', 'count': {'$gt': 0}}, [('count', DESC)]),
+    ('related', {'related._id': SAMPLE_ID}, None),
+    ('jobs', {'$or': [{'status': 'queued'}, {'status': 'running', 'heartbeat': {'$lt': SAMPLE_DATE}}]}, [('date_added', ASC)]),
+]
+
+
+def plan_stages(plan):
+    yield plan.get('stage')
+    children = []
+    if 'inputStage' in plan:
+        children.append(plan['inputStage'])
+    children.extend(plan.get('inputStages', []))
+    for child in children:
+        for stage in plan_stages(child):
+            yield stage
+
+
+def check_query_plans(db):
+    failures = []
+    for collection_name, query, sort in QUERY_SHAPES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain()['queryPlanner']['winningPlan']
+        # the slot based engine nests the classic plan under queryPlan
+        winning_plan = winning_plan.get('queryPlan', winning_plan)
+        stages = set(plan_stages(winning_plan))
+        ok = 'COLLSCAN' not in stages
+        print('{:<4} {}.find({}) sort={}'.format('ok' if ok else 'FAIL', collection_name, query, sort))
+        if not ok:
+            failures.append((collection_name, query, sort))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create and verify the bucket list indexes')
+    parser.add_argument('command', choices=['apply', 'check'],
+                        help='apply: create missing indexes; check: fail if any route query does a COLLSCAN')
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient(os.getenv('MONGO'))[os.getenv('MONGO_DB', 'bucket_list')]
+    if args.command == 'apply':
+        ensure_indexes(db)
+        print('Indexes are up to date.')
+    else:
+        failures = check_query_plans(db)
+        if failures:
+            print('%d query shape(s) fall back to COLLSCAN.' % len(failures))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,19 @@
+import argparse
+import csv
+import json
 import pymongo
 import datetime
+import itertools
 import os
 from dotenv import load_dotenv
+from indexes import ensure_indexes
+from passwords import hash_password, hash_passwords, is_bcrypt_hash
+from conditional import bump_version
+import stats
+from datagen import generate_activities, generate_users, insert_batches
+from normalize import normalize_activity
+from geocode import geocode_activity
+from repository import object_id
 
 ## necessary for python-dotenv ##
 APP_ROOT = os.path.join(os.path.dirname(__file__), '..')   # refers to application_top
@@ -11,13 +23,14 @@ load_dotenv(dotenv_path)
 mongo = os.getenv('MONGO')
 client = pymongo.MongoClient(mongo)
 
-db = client['bucket_list']
+db = client[os.getenv('MONGO_DB', 'bucket_list')]
 
 users = db['users']
 roles = db['roles']
 bucketList = db['bucketList']
 categories = db['categories']
 status = db['status']
+counters = db['counters']
 
 
 def add_role(role_name):
@@ -36,7 +49,7 @@ def add_user(first_name, last_name, username, email, password, role):
         'last_name': last_name,
         'username' : username,
         'email': email,
-        'password': password,
+        'password': hash_password(password),
         'role': role,
         'date_added': datetime.datetime.now(),
         'date_modified': datetime.datetime.now()
@@ -62,7 +75,7 @@ def add_activity(activity_name, category, description, share_status, estimated_c
         'date_added': datetime.datetime.now(),
         'date_modified': datetime.datetime.now()
     }
-    return bucketList.insert_one(activity_data)
+    return bucketList.insert_one(geocode_activity(normalize_activity(activity_data)))
 
 def add_category(category_name):
     category_data = {
@@ -102,8 +115,121 @@ def initial_database():
 
     
 
-def main():
-    initial_database()
-   
+########## bulk loading ##########
+DATE_FIELDS = ('date_added', 'date_modified')
+
+
+def read_rows(path):
+    # yields one dict per line of a .jsonl file or per row of a .csv file
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield row
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def prepare_row(row, now):
+    for field in DATE_FIELDS:
+        value = row.get(field)
+        if not value:
+            row[field] = now
+        elif isinstance(value, str):
+            row[field] = datetime.datetime.fromisoformat(value)
+    # exported rows carry their _id as text; rows without a valid one get a new _id
+    if '_id' in row:
+        _id = object_id(row.pop('_id'))
+        if _id:
+            row['_id'] = _id
+    return row
+
+
+def prepare_activity(row, now):
+    # string costs are dollar amounts ('$150', '150'); numbers are already cents
+    return geocode_activity(normalize_activity(prepare_row(row, now)))
+
+
+def prepare_users(rows, now, rounds=None, chunk_size=1000):
+    # plain text passwords are hashed a chunk at a time on every bcrypt worker;
+    # rows that already carry a bcrypt hash are loaded as is
+    rows = iter(rows)
+    chunk = list(itertools.islice(rows, chunk_size))
+    while chunk:
+        plain = [row for row in chunk if not is_bcrypt_hash(row.get('password'))]
+        for row, hashed in zip(plain, hash_passwords([row.get('password') or '' for row in plain], rounds)):
+            row['password'] = hashed
+        for row in chunk:
+            yield prepare_row(row, now)
+        chunk = list(itertools.islice(rows, chunk_size))
+
+
+def load_file(path, kind, batch_size, bcrypt_rounds=None):
+    now = datetime.datetime.now()
+    if kind == 'users':
+        rows = prepare_users(read_rows(path), now, bcrypt_rounds)
+        return insert_batches(users, rows, batch_size, label='users')
+    rows = (prepare_activity(row, now) for row in read_rows(path))
+    return insert_batches(bucketList, rows, batch_size, label='activities')
+
+
+def write_jsonl(path, docs):
+    with open(path, 'w') as f:
+        for doc in docs:
+            for field in DATE_FIELDS:
+                doc[field] = doc[field].isoformat()
+            if doc.get('expected_date'):
+                doc['expected_date'] = doc['expected_date'].strftime('%Y-%m-%d')
+            f.write(json.dumps(doc) + '\n')
+
+
+def generate(activity_count, user_count, seed, batch_size, output_dir=None, password='abc123'):
+    # every generated user shares one low cost hash; logging in upgrades it
+    password_hash = hash_password(password, rounds=4)
+    user_docs = generate_users(user_count, seed, password_hash)
+    activity_docs = generate_activities(activity_count, user_count, seed)
+    if output_dir:
+        write_jsonl(os.path.join(output_dir, 'users.jsonl'), user_docs)
+        write_jsonl(os.path.join(output_dir, 'activities.jsonl'), activity_docs)
+        return
+    insert_batches(users, user_docs, batch_size, label='users')
+    insert_batches(bucketList, activity_docs, batch_size, label='activities')
 
-main()
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed, bulk load or generate bucket list data')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('seed', help='create the roles, categories, statuses, admin user and sample activity (default)')
+
+    load_parser = subparsers.add_parser('load', help='bulk insert users or activities from .jsonl or .csv files')
+    load_parser.add_argument('kind', choices=['users', 'activities'])
+    load_parser.add_argument('paths', nargs='+')
+    load_parser.add_argument('--batch-size', type=int, default=1000)
+    load_parser.add_argument('--bcrypt-rounds', type=int,
+                             help='cost for plain text passwords (default BCRYPT_ROUNDS); logging in upgrades cheaper hashes')
+
+    generate_parser = subparsers.add_parser('generate', help='insert deterministic synthetic users and activities')
+    generate_parser.add_argument('--activities', type=int, default=100000)
+    generate_parser.add_argument('--users', type=int, default=1000)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.add_argument('--batch-size', type=int, default=1000)
+    generate_parser.add_argument('--output-dir', help='write users.jsonl and activities.jsonl here instead of inserting')
+
+    args = parser.parse_args()
+    if args.command in (None, 'seed'):
+        ensure_indexes(db)
+        initial_database()
+    elif args.command == 'load':
+        for path in args.paths:
+            load_file(path, args.kind, args.batch_size, args.bcrypt_rounds)
+    elif args.command == 'generate':
+        generate(args.activities, args.users, args.seed, args.batch_size, args.output_dir)
+    # cached activity listings and the statistics are stale after any of these
+    bump_version(counters, 'bucketList')
+    stats.rebuild(bucketList, db['stats'])
+    stats.rebuild_user_summaries(bucketList, db['users'])
+
+
+if __name__ == '__main__':
+    main()
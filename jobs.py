@@ -0,0 +1,108 @@
+import datetime
+import logging
+import os
+import socket
+import threading
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import PyMongoError
+
+log = logging.getLogger('bucket_list')
+
+# A small queue for work too long to do inside a request, kept in the jobs
+# collection so it survives restarts. Each process runs one worker thread that
+# claims queued jobs one at a time with an atomic find_one_and_update, so any
+# number of processes can share the queue. A running job writes a heartbeat with
+# every progress report; one whose heartbeat stops (its process died or was
+# restarted) is claimed again and its handler runs from the start, so handlers must
+# only do the work that is still outstanding.
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobRunner:
+    def __init__(self, jobs, handlers, poll_seconds=5, stale_seconds=60, max_attempts=3):
+        # handlers maps a job kind to handler(params, report); report(processed=0,
+        # remaining=None) records progress and keeps the job's claim alive
+        self.jobs = jobs
+        self.handlers = handlers
+        self.poll_seconds = poll_seconds
+        self.stale_seconds = stale_seconds
+        self.max_attempts = max_attempts
+        self.worker = '%s:%d' % (socket.gethostname(), os.getpid())
+        self._wake = threading.Event()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, kind, **params):
+        now = datetime.datetime.now()
+        job = {'kind': kind, 'params': params, 'status': QUEUED, 'processed': 0, 'total': None,
+               'attempts': 0, 'error': None, 'heartbeat': None, 'date_added': now, 'date_modified': now}
+        _id = self.jobs.insert_one(job).inserted_id
+        self.start()
+        self._wake.set()
+        return _id
+
+    def start(self):
+        # one worker thread per process, started after any fork
+        pid = os.getpid()
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self.worker = '%s:%d' % (socket.gethostname(), pid)
+        threading.Thread(target=self.run, name='job-runner', daemon=True).start()
+
+    def claim(self):
+        now = datetime.datetime.now()
+        stale = now - datetime.timedelta(seconds=self.stale_seconds)
+        return self.jobs.find_one_and_update(
+            {'$or': [{'status': QUEUED}, {'status': RUNNING, 'heartbeat': {'$lt': stale}}]},
+            {'$set': {'status': RUNNING, 'worker': self.worker, 'heartbeat': now, 'date_modified': now},
+             '$inc': {'attempts': 1}},
+            sort=[('date_added', ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+
+    def run(self):
+        while True:
+            try:
+                job = self.claim()
+            except PyMongoError:
+                log.exception('Could not claim a job.')
+                job = None
+            if job:
+                self.run_job(job)
+                continue
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+
+    def run_job(self, job):
+        if job['attempts'] > self.max_attempts:
+            self.finish(job, FAILED, 'Gave up after %d attempts.' % self.max_attempts)
+            return
+        processed = [job.get('processed') or 0]
+
+        def report(count=0, remaining=None):
+            now = datetime.datetime.now()
+            processed[0] += count
+            changes = {'processed': processed[0], 'heartbeat': now, 'date_modified': now}
+            if remaining is not None:
+                changes['total'] = processed[0] + remaining
+            self.jobs.update_one({'_id': job['_id']}, {'$set': changes})
+
+        try:
+            self.handlers[job['kind']](job['params'], report)
+        except Exception as e:
+            log.exception('Job %s (%s) failed.', job['_id'], job['kind'])
+            self.finish(job, FAILED, '%s: %s' % (type(e).__name__, e))
+        else:
+            self.finish(job, DONE)
+
+    def finish(self, job, status, error=None):
+        self.jobs.update_one({'_id': job['_id']},
+                             {'$set': {'status': status, 'error': error, 'date_modified': datetime.datetime.now()}})
+
+    def recent(self, limit=50):
+        return list(self.jobs.find().sort('date_added', DESCENDING).limit(limit))
@@ -0,0 +1,260 @@
+import argparse
+import collections
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import pymongo
+from pymongo.errors import OperationFailure, PyMongoError
+from dotenv import load_dotenv
+from normalize import format_cost, format_date
+
+## necessary for python-dotenv ##
+APP_ROOT = os.path.join(os.path.dirname(__file__), '..')   # refers to application_top
+dotenv_path = os.path.join(APP_ROOT, '.env')
+load_dotenv(dotenv_path)
+
+log = logging.getLogger('bucket_list')
+
+# Live updates for the public activity list. Each process runs one change stream on
+# bucketList in a background thread and hands every change to its subscribers, the
+# open Server-Sent Events connections. An event's id is its change's resume token,
+# so a browser that reconnects with Last-Event-ID gets what it missed: from the
+# recent events kept in memory, or from a change stream resumed at that token when
+# they have already gone (or it was connected to another process). Change streams
+# need a replica set; a single node one is enough.
+
+PIPELINE = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']},
+                        '$or': [{'operationType': 'delete'},
+                                {'fullDocument.share_status': 'Public'},
+                                # an activity made private has to leave the pages showing it
+                                {'updateDescription.updatedFields.share_status': {'$exists': True}}]}}]
+
+# the server no longer has the oplog entry a resume token points to
+CHANGE_STREAM_HISTORY_LOST = 286
+# change streams were opened on a standalone server
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+# sent instead of the missed events when they can't be recovered; the page reloads
+RESET = (None, {'op': 'reset'})
+
+HEARTBEAT_SECONDS = 15
+
+# browsers wait this many milliseconds before reconnecting
+RETRY_MESSAGE = 'retry: 3000\n\n'
+
+
+def feed_event(change):
+    # (id, data); deletes can't be told apart from private ones, so a removal is sent
+    # for any deleted activity and pages drop it if they show it
+    _id = str(change['documentKey']['_id'])
+    activity = change.get('fullDocument')
+    if change['operationType'] == 'delete' or not activity or activity.get('share_status') != 'Public':
+        data = {'op': 'remove', '_id': _id}
+    else:
+        data = {'op': 'insert' if change['operationType'] == 'insert' else 'update', '_id': _id, 'activity': {
+            'activity_name': activity.get('activity_name'),
+            'category': activity.get('category'),
+            'username': activity.get('username'),
+            'share_status': activity.get('share_status'),
+            'estimated_cost': format_cost(activity.get('estimated_cost')),
+            'expected_date': format_date(activity.get('expected_date')),
+            'date_added': str(activity.get('date_added') or ''),
+        }}
+    # hex encoded resume tokens sort in the order of the changes they stand for
+    return change['_id']['_data'], data
+
+
+class Subscriber:
+    def __init__(self, size):
+        self.queue = queue.Queue(size)
+        self.dropped = False
+
+    def deliver(self, event):
+        # a subscriber too slow to keep up is dropped; its browser reconnects and
+        # catches up from its last event id
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped = True
+        return not self.dropped
+
+
+class ChangeFeed:
+    def __init__(self, collection, recent_size=1000, queue_size=1000, retry_seconds=5, max_retry_seconds=300):
+        self.collection = collection
+        self.recent = collections.deque(maxlen=recent_size)
+        self.queue_size = queue_size
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.subscribers = set()
+        self.token = None           # resume token of the last change published
+        self.unsupported = False    # set once the server turns out not to be a replica set
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def watch(self, resume_after=None):
+        return self.collection.watch(PIPELINE, full_document='updateLookup', resume_after=resume_after)
+
+    def start(self):
+        # the watcher thread is started by the first subscriber in each process, so a
+        # prefork server's master never starts one its workers would not inherit
+        pid = os.getpid()
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self.subscribers = set()
+        threading.Thread(target=self.run, name='change-feed', daemon=True).start()
+
+    def run(self):
+        delay = self.retry_seconds
+        while True:
+            try:
+                with self.watch(self.token) as stream:
+                    delay = self.retry_seconds
+                    for change in stream:
+                        self.publish(feed_event(change), change['_id'])
+                # the stream ends on an invalidate, e.g. when bucketList is dropped
+                self.token = None
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                    # open connections end at their next heartbeat and new ones are refused
+                    log.warning('Live updates are off: change streams need a replica set.')
+                    self.unsupported = True
+                    return
+                if e.code != CHANGE_STREAM_HISTORY_LOST:
+                    delay = self.retry(delay)
+                    continue
+                log.warning('Change feed fell off the oplog; starting again from now.')
+                self.token = None
+                with self._lock:
+                    self.recent.clear()
+                self.broadcast(RESET)
+            except PyMongoError:
+                delay = self.retry(delay)
+
+    def retry(self, delay):
+        # waits twice as long after every failure in a row, and logs the traceback
+        # of the first one only
+        if delay == self.retry_seconds:
+            log.exception('Change feed failed, retrying in %ds.', delay)
+        else:
+            log.warning('Change feed still failing, retrying in %ds.', delay)
+        time.sleep(delay)
+        return min(delay * 2, self.max_retry_seconds)
+
+    def publish(self, event, token=None):
+        with self._lock:
+            self.recent.append(event)
+            if token:
+                self.token = token
+        self.broadcast(event)
+
+    def broadcast(self, event):
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            if not subscriber.deliver(event):
+                self.unsubscribe(subscriber)
+
+    def subscribe(self, subscriber):
+        self.start()
+        with self._lock:
+            self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers.discard(subscriber)
+
+    def missed(self, last_id):
+        # the events after last_id, or None if they can no longer be recovered
+        with self._lock:
+            recent = list(self.recent)
+        if recent and recent[0][0] <= last_id:
+            return [event for event in recent if event[0] > last_id]
+        return self.catch_up(last_id)
+
+    def catch_up(self, last_id):
+        events = []
+        try:
+            with self.watch({'_data': last_id}) as stream:
+                change = stream.try_next()
+                while change is not None:
+                    if len(events) == self.recent.maxlen:
+                        return None
+                    events.append(feed_event(change))
+                    change = stream.try_next()
+        except PyMongoError:
+            return None
+        return events
+
+    def stream(self, last_id=None, heartbeat=HEARTBEAT_SECONDS, max_seconds=None):
+        # events for one connection, with None every heartbeat seconds while nothing
+        # happens. It subscribes before replaying what was missed, so nothing falls
+        # between the two; anything seen twice is skipped by id. With max_seconds
+        # it ends after that long, and the browser reconnects from its last event
+        deadline = time.monotonic() + max_seconds if max_seconds else None
+        subscriber = Subscriber(self.queue_size)
+        self.subscribe(subscriber)
+        try:
+            if last_id:
+                missed = self.missed(last_id)
+                if missed is None:
+                    yield RESET
+                    return
+                for event in missed:
+                    yield event
+                    last_id = event[0]
+            while True:
+                timeout = heartbeat
+                if deadline is not None:
+                    timeout = min(timeout, deadline - time.monotonic())
+                    if timeout <= 0:
+                        return
+                try:
+                    event = subscriber.queue.get(timeout=timeout)
+                except queue.Empty:
+                    if subscriber.dropped or self.unsupported:
+                        return
+                    yield None
+                    continue
+                if event[0] and last_id and event[0] <= last_id:
+                    continue
+                last_id = event[0] or last_id
+                yield event
+        finally:
+            self.unsubscribe(subscriber)
+
+
+def sse_message(event):
+    if event is None:
+        return ': keepalive\n\n'
+    event_id, data = event
+    message = 'event: activity\n'
+    if event_id:
+        message += 'id: %s\n' % event_id
+    return message + 'data: %s\n\n' % json.dumps(data)
+
+
+def sse_lines(events):
+    yield RETRY_MESSAGE
+    for event in events:
+        yield sse_message(event)
+
+
+def main():
+    # prints the feed, to try it against a local replica set
+    parser = argparse.ArgumentParser(description='Print the live activity feed')
+    parser.add_argument('--last-event-id', help='resume after this event id')
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient(os.getenv('MONGO'))[os.getenv('MONGO_DB', 'bucket_list')]
+    for message in sse_lines(ChangeFeed(db['bucketList']).stream(args.last_event_id)):
+        print(message, end='', flush=True)
+
+
+if __name__ == '__main__':
+    main()
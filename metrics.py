@@ -0,0 +1,159 @@
+import logging
+import random
+import threading
+from flask import has_request_context, request
+from pymongo import monitoring
+
+# Prometheus text exposition for per-route request timings and the Mongo commands
+# each route issues. Metrics are kept per process.
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, escape(value)) for name, value in pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self._lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name, format_labels(self.labels, labels), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket..., +Inf count, sum]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for labels, counts in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels, labels, [('le', bound)]), count))
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels, labels, [('le', '+Inf')]), counts[-2]))
+                lines.append('%s_sum%s %s' % (self.name, format_labels(self.labels, labels), counts[-1]))
+                lines.append('%s_count%s %d' % (self.name, format_labels(self.labels, labels), counts[-2]))
+        return lines
+
+
+class CallbackMetric:
+    # a counter or gauge whose value is read from a callback at scrape time
+    def __init__(self, name, help, type, read):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.read = read
+
+    def render(self):
+        return ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type),
+                '%s %s' % (self.name, self.read())]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_seconds = registry.add(Histogram(
+    'bucket_list_request_seconds', 'Time spent handling a request.', ('endpoint', 'method', 'status')))
+mongo_commands = registry.add(Counter(
+    'bucket_list_mongo_commands_total', 'Mongo commands issued.', ('endpoint', 'command')))
+mongo_command_errors = registry.add(Counter(
+    'bucket_list_mongo_command_errors_total', 'Mongo commands that failed.', ('endpoint', 'command')))
+mongo_documents = registry.add(Counter(
+    'bucket_list_mongo_documents_returned_total', 'Documents returned by find and getMore.', ('endpoint', 'command')))
+mongo_command_seconds = registry.add(Histogram(
+    'bucket_list_mongo_command_seconds', 'Mongo command round trip time.', ('endpoint', 'command')))
+
+
+def current_endpoint():
+    # pymongo calls listeners on the thread that issued the command
+    if has_request_context():
+        return request.endpoint or 'unknown'
+    return 'none'
+
+
+def documents_returned(reply):
+    cursor = reply.get('cursor') if isinstance(reply, dict) else None
+    if cursor:
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', ())))
+    return 0
+
+
+class QueryListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        labels = (current_endpoint(), event.command_name)
+        mongo_commands.inc(labels)
+        mongo_command_seconds.observe(labels, event.duration_micros / 1e6)
+        returned = documents_returned(event.reply)
+        if returned:
+            mongo_documents.inc(labels, returned)
+
+    def failed(self, event):
+        labels = (current_endpoint(), event.command_name)
+        mongo_commands.inc(labels)
+        mongo_command_errors.inc(labels)
+        mongo_command_seconds.observe(labels, event.duration_micros / 1e6)
+
+
+class SamplingFilter(logging.Filter):
+    # lets through every WARNING and above, and only a sample of lower level records
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
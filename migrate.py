@@ -0,0 +1,108 @@
+import argparse
+import datetime
+import os
+import pymongo
+from pymongo import UpdateOne
+from dotenv import load_dotenv
+from normalize import normalize_activity, parse_timestamp
+from geocode import geocode_activity
+from conditional import bump_version
+
+## necessary for python-dotenv ##
+APP_ROOT = os.path.join(os.path.dirname(__file__), '..')   # refers to application_top
+dotenv_path = os.path.join(APP_ROOT, '.env')
+load_dotenv(dotenv_path)
+
+# One-off conversions of activities written before a field was added or typed.
+# Documents are walked in _id order in batches and the last _id of every finished
+# batch is checkpointed in the migrations collection, so an interrupted run picks
+# up where it stopped. Rerunning a finished migration is a no-op.
+
+
+def typed_fields(doc):
+    return normalize_activity({'estimated_cost': doc.get('estimated_cost'),
+                               'expected_date': doc.get('expected_date')})
+
+
+def locations(doc):
+    return geocode_activity({'city': doc.get('city'), 'state': doc.get('state'), 'country': doc.get('country')})
+
+
+def timestamps(doc):
+    return {field: parse_timestamp(doc.get(field), doc['_id']) for field in ('date_added', 'date_modified')}
+
+
+# name -> (query for documents that still need it, fields it reads, conversion)
+MIGRATIONS = {
+    'typed_cost_and_date': ({'$or': [{'estimated_cost': {'$type': 'string'}},
+                                     {'expected_date': {'$type': 'string'}}]},
+                            ('estimated_cost', 'expected_date'), typed_fields),
+    # activities never geocoded, or that matched nothing in the gazetteer last time
+    'locations': ({'location': None},
+                  ('city', 'state', 'country'), locations),
+    # edits before date_added was left out of the edit form saved it back as text
+    'timestamps': ({'$or': [{'date_added': {'$type': 'string'}}, {'date_modified': {'$type': 'string'}}]},
+                   ('date_added', 'date_modified'), timestamps),
+}
+
+
+def run_migration(db, name, batch_size=1000, progress=True):
+    pending, fields, convert = MIGRATIONS[name]
+    bucketList = db['bucketList']
+    migrations = db['migrations']
+    state = migrations.find_one({'_id': name}) or {}
+    last_id = state.get('last_id')
+    converted = state.get('converted', 0)
+
+    while True:
+        query = pending
+        if last_id is not None:
+            query = {'$and': [pending, {'_id': {'$gt': last_id}}]}
+        batch = list(bucketList.find(query, {field: 1 for field in fields})
+                     .sort('_id', pymongo.ASCENDING).limit(batch_size))
+        if not batch:
+            break
+        operations = []
+        for doc in batch:
+            # only touch documents that still hold the values we read
+            current = {field: doc.get(field) for field in fields}
+            operations.append(UpdateOne(dict(current, _id=doc['_id']), {'$set': convert(doc)}))
+        result = bucketList.bulk_write(operations, ordered=False)
+        converted += result.modified_count
+        last_id = batch[-1]['_id']
+        migrations.update_one({'_id': name},
+                              {'$set': {'last_id': last_id, 'converted': converted,
+                                        'date_modified': datetime.datetime.now()}},
+                              upsert=True)
+        if progress:
+            print('%s: %d activities converted' % (name, converted))
+
+    migrations.update_one({'_id': name},
+                          {'$set': {'done': True, 'converted': converted,
+                                    'date_modified': datetime.datetime.now()}},
+                          upsert=True)
+    # activities converted by this run
+    return converted - state.get('converted', 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bring stored activities up to the current document shape')
+    parser.add_argument('--only', action='append', choices=sorted(MIGRATIONS), help='run just this migration (repeatable)')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--restart', action='store_true', help='forget the checkpoint and scan from the start')
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient(os.getenv('MONGO'))[os.getenv('MONGO_DB', 'bucket_list')]
+    converted = 0
+    for name in args.only or MIGRATIONS:
+        if args.restart:
+            db['migrations'].delete_one({'_id': name})
+        converted += run_migration(db, name, args.batch_size)
+    if converted:
+        # listings and statistics rendered from the old documents are stale
+        bump_version(db['counters'], 'bucketList')
+    print('Converted %d activities.' % converted)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import datetime
+import re
+
+# estimated_cost is stored as an integer number of cents and expected_date as a
+# date (a BSON datetime at midnight), so both can be indexed and range-filtered.
+# Values that can't be parsed are stored as None with the original text kept
+# alongside in estimated_cost_text / expected_date_text.
+
+COST_RE = re.compile(r'[\d,]*\.?\d+')
+DATE_FORMATS = ('%m/%d/%Y', '%Y-%m-%d', '%m/%d/%y', '%m-%d-%Y')
+
+
+def parse_cost_cents(value):
+    # '$1,250.50' -> 125050
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(round(value * 100))
+    match = COST_RE.search(value)
+    if not match:
+        return None
+    return int(round(float(match.group(0).replace(',', '')) * 100))
+
+
+def parse_date(value):
+    if isinstance(value, datetime.datetime):
+        return datetime.datetime(value.year, value.month, value.day)
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime((value or '').strip(), date_format)
+        except ValueError:
+            pass
+    return None
+
+
+def parse_timestamp(value, _id=None):
+    # date_added as saved by older edit forms, which posted it back as text
+    # ('2021-01-05 12:34:56.123456'); otherwise the time the ObjectId was made
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.fromisoformat(value.strip()).replace(tzinfo=None)
+        except ValueError:
+            parsed = parse_date(value)
+            if parsed:
+                return parsed
+    if _id is not None:
+        return _id.generation_time.replace(tzinfo=None)
+    return None
+
+
+def normalize_activity(activity):
+    # converts estimated_cost and expected_date in place and returns the activity
+    for field, parse in (('estimated_cost', parse_cost_cents), ('expected_date', parse_date)):
+        if field not in activity:
+            continue
+        value = activity[field]
+        parsed = parse(value)
+        activity[field] = parsed
+        if parsed is None and value not in (None, ''):
+            activity[field + '_text'] = value
+        else:
+            activity.pop(field + '_text', None)
+    return activity
+
+
+def format_cost(cents):
+    if cents is None:
+        return ''
+    if not isinstance(cents, int):
+        return cents   # not migrated yet
+    if cents % 100:
+        return '${:,.2f}'.format(cents / 100)
+    return '${:,}'.format(cents // 100)
+
+
+def format_date(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.strftime('%m/%d/%Y')
+    return value or ''
+
+
+def range_filters(args):
+    # query conditions for the cost_min/cost_max (dollars) and date_from/date_to
+    # (any DATE_FORMATS) filters on the activity listing; unparseable bounds are ignored
+    query = {}
+    cost = {}
+    for arg, op in (('cost_min', '$gte'), ('cost_max', '$lte')):
+        cents = parse_cost_cents(args.get(arg) or None)
+        if cents is not None:
+            cost[op] = cents
+    if cost:
+        query['estimated_cost'] = cost
+    dates = {}
+    for arg, op in (('date_from', '$gte'), ('date_to', '$lte')):
+        date = parse_date(args.get(arg))
+        if date is not None:
+            dates[op] = date
+    if dates:
+        query['expected_date'] = dates
+    return query
+
+
+FILTER_ARGS = ('cost_min', 'cost_max', 'date_from', 'date_to')
+
+
+def filter_args(args):
+    # the filter arguments that were given, to carry over to the pagination links
+    return {arg: args[arg] for arg in FILTER_ARGS if args.get(arg)}
@@ -0,0 +1,94 @@
+import datetime
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from normalize import parse_timestamp
+
+PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+# list pages are ordered newest first on (date_added, _id)
+SORT_DESC = [('date_added', -1), ('_id', -1)]
+SORT_ASC = [('date_added', 1), ('_id', 1)]
+
+
+def encode_cursor(doc):
+    # date_added may still be text on activities not yet migrated
+    return parse_timestamp(doc['date_added'], doc['_id']).strftime(CURSOR_DATE_FORMAT) + '_' + str(doc['_id'])
+
+
+def decode_cursor(cursor):
+    # returns (date_added, _id) or None if the cursor is missing or malformed
+    if not cursor:
+        return None
+    try:
+        date_part, id_part = cursor.split('_', 1)
+        return datetime.datetime.strptime(date_part, CURSOR_DATE_FORMAT), ObjectId(id_part)
+    except (ValueError, InvalidId):
+        return None
+
+
+def page_size(value):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+class Page:
+    def __init__(self, rows, per_page, next_cursor=None, prev_cursor=None, args=None):
+        self.rows = rows
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        # extra query string arguments carried over to the next/prev links
+        self.args = args or {}
+
+    def next_args(self):
+        return dict(self.args, after=self.next_cursor, per_page=self.per_page)
+
+    def prev_args(self):
+        return dict(self.args, before=self.prev_cursor, per_page=self.per_page)
+
+
+def keyset_query(query, after=None, before=None):
+    # returns the bounded query, its sort and the decoded cursors
+    after = decode_cursor(after)
+    before = None if after else decode_cursor(before)
+
+    if after:
+        date_added, _id = after
+        bound = {'$or': [{'date_added': {'$lt': date_added}},
+                         {'date_added': date_added, '_id': {'$lt': _id}}]}
+        sort = SORT_DESC
+    elif before:
+        date_added, _id = before
+        bound = {'$or': [{'date_added': {'$gt': date_added}},
+                         {'date_added': date_added, '_id': {'$gt': _id}}]}
+        sort = SORT_ASC
+    else:
+        bound = None
+        sort = SORT_DESC
+
+    if bound:
+        query = {'$and': [query, bound]}
+    return query, sort, after, before
+
+
+def keyset_result(rows, per_page, after=None, before=None, args=None):
+    # rows were fetched with a limit of per_page + 1 to find out whether there is another page
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_more or before:
+            next_cursor = encode_cursor(rows[-1])
+        if after or (before and has_more):
+            prev_cursor = encode_cursor(rows[0])
+    return Page(rows, per_page, next_cursor, prev_cursor, args)
+
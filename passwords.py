@@ -0,0 +1,68 @@
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import bcrypt
+
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+BCRYPT_WORKERS = int(os.getenv('BCRYPT_WORKERS', os.cpu_count() or 1))
+BCRYPT_TIMEOUT = float(os.getenv('BCRYPT_TIMEOUT', 10))
+
+# The request thread still waits for its hash; the pool only caps how many hashes
+# run at once at BCRYPT_WORKERS, so a burst of logins queues instead of
+# oversubscribing the CPUs. A request that waits longer than BCRYPT_TIMEOUT gets
+# PasswordsBusy and is asked to try again.
+executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix='bcrypt')
+
+
+class PasswordsBusy(Exception):
+    pass
+
+
+def is_bcrypt_hash(stored):
+    return isinstance(stored, str) and stored.startswith(('$2a$', '$2b$', '$2y$'))
+
+
+def hash_rounds(stored):
+    # '$2b$12$...' -> 12
+    return int(stored.split('$')[2])
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(stored, password):
+    if is_bcrypt_hash(stored):
+        return bcrypt.checkpw(password.encode('utf-8'), stored.encode('utf-8'))
+    # accounts created before passwords were hashed still hold the plain text
+    return hmac.compare_digest(str(stored).encode('utf-8'), password.encode('utf-8'))
+
+
+def run(func, *args):
+    future = executor.submit(func, *args)
+    try:
+        return future.result(BCRYPT_TIMEOUT)
+    except TimeoutError:
+        # still queued behind other hashes; don't leave it to run for nobody
+        future.cancel()
+        raise PasswordsBusy()
+
+
+def hash_password(password, rounds=None):
+    return run(_hash, password, rounds or BCRYPT_ROUNDS)
+
+
+def hash_passwords(passwords, rounds=None):
+    # many hashes at once across the whole pool, for bulk loads; no timeout
+    rounds = rounds or BCRYPT_ROUNDS
+    return list(executor.map(_hash, passwords, [rounds] * len(passwords)))
+
+
+def check_password(stored, password):
+    if stored is None:
+        return False
+    return run(_check, stored, password)
+
+
+def needs_rehash(stored, rounds=None):
+    return not is_bcrypt_hash(stored) or hash_rounds(stored) < (rounds or BCRYPT_ROUNDS)
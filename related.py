@@ -0,0 +1,357 @@
+import argparse
+import datetime
+import logging
+import os
+import sys
+import threading
+import time
+import pymongo
+from bson.objectid import ObjectId
+from pymongo import ReplaceOne, UpdateOne
+from dotenv import load_dotenv
+from search import TOKEN_RE
+
+# numpy and scipy are optional: pip install numpy scipy. Without them the related
+# panel still shows whatever was last computed, but nothing is recomputed
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+## necessary for python-dotenv ##
+APP_ROOT = os.path.join(os.path.dirname(__file__), '..')   # refers to application_top
+dotenv_path = os.path.join(APP_ROOT, '.env')
+load_dotenv(dotenv_path)
+
+log = logging.getLogger('bucket_list')
+
+# "Related activities" for the print-activity page: the public activities whose
+# TF-IDF vectors over name, description and category have the highest cosine
+# similarity. `related.py rebuild` computes every activity's list in one batch and
+# stores it in the related collection, so a page only reads one document; it also
+# saves the model (vocabulary, idf weights and champion lists) to RELATED_MODEL_PATH,
+# which RelatedIndex loads to refresh the lists of activities as they are saved.
+#
+# Candidates are found through champion lists: each term keeps only the CHAMPIONS
+# public activities that weigh it highest, and an activity's scores are its dot
+# products with those. That bounds the work per activity however common its terms
+# are, at the cost of missing candidates that never make a champion list.
+
+TOP_K = 8
+CHAMPIONS = 200
+# terms in more than this share of activities carry no information, like 'in'
+MAX_DF = 0.5
+BLOCK_ROWS = 2000
+FIELDS = ('activity_name', 'description', 'category', 'share_status')
+
+MODEL_PATH = os.getenv('RELATED_MODEL_PATH') or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                             'data', 'related-model.npz')
+
+
+def available():
+    return np is not None
+
+
+def activity_terms(activity):
+    # name terms count twice, since the name says most about an activity
+    name = TOKEN_RE.findall((activity.get('activity_name') or '').casefold())
+    description = TOKEN_RE.findall((activity.get('description') or '').casefold())
+    terms = [term for term in name + name + description if len(term) > 1]
+    if activity.get('category'):
+        terms.append('category:' + activity['category'].casefold())
+    return terms
+
+
+def count_matrix(activities, vocab, grow=False):
+    # term counts, one row per activity; with grow, unseen terms are added to vocab
+    indptr = [0]
+    indices = []
+    for activity in activities:
+        counts = {}
+        for term in activity_terms(activity):
+            col = vocab.get(term)
+            if col is None and grow:
+                col = vocab[term] = len(vocab)
+            if col is not None:
+                counts[col] = counts.get(col, 0) + 1
+        indices.extend(counts.items())
+        indptr.append(len(indices))
+    cols = np.fromiter((col for col, count in indices), dtype=np.int32, count=len(indices))
+    data = np.fromiter((count for col, count in indices), dtype=np.float32, count=len(indices))
+    return sparse.csr_matrix((data, cols, np.array(indptr, dtype=np.int64)), shape=(len(indptr) - 1, len(vocab)))
+
+
+def weigh(counts, idf):
+    # sublinear tf times idf, each row scaled to unit length
+    X = counts.copy()
+    X.data = (1 + np.log(X.data)) * idf[X.indices]
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    X = sparse.diags(1 / norms).dot(X).tocsr()
+    X.eliminate_zeros()
+    return X.astype(np.float32)
+
+
+def champion_lists(P, champions):
+    # the candidates (rows of P) that weigh each term highest, as a terms x candidates matrix
+    C = P.tocsc()
+    keep = np.zeros(C.nnz, dtype=bool)
+    for term in range(C.shape[1]):
+        start, end = C.indptr[term], C.indptr[term + 1]
+        if end - start <= champions:
+            keep[start:end] = True
+        else:
+            keep[start + np.argpartition(-C.data[start:end], champions)[:champions]] = True
+    C.data[~keep] = 0
+    C.eliminate_zeros()
+    return C.T.tocsr()
+
+
+def as_bytes(value):
+    # numpy drops the trailing zero bytes of fixed width byte strings
+    return bytes(value).ljust(12, b'\0')
+
+
+class Model:
+    def __init__(self, vocab, idf, champions, candidate_ids):
+        self.vocab = vocab                  # term -> column
+        self.idf = idf
+        self.champions = champions          # terms x candidates
+        self.candidate_ids = candidate_ids  # ObjectId bytes of the candidates, sorted
+
+    @classmethod
+    def build(cls, counts, vocab, ids, public, champions=CHAMPIONS, max_df=MAX_DF):
+        # counts from count_matrix over activities in _id order; returns the model
+        # and the weighted rows of every activity
+        n = counts.shape[0]
+        df = np.bincount(counts.indices, minlength=len(vocab))
+        idf = (np.log((1.0 + n) / (1.0 + df)) + 1).astype(np.float32)
+        idf[df > max(max_df * n, 1)] = 0
+        X = weigh(counts, idf)
+        public_rows = np.flatnonzero(public)
+        candidate_ids = np.array([ids[row].binary for row in public_rows], dtype='S12')
+        return cls(vocab, idf, champion_lists(X[public_rows], champions), candidate_ids), X, public_rows
+
+    def vectors(self, activities):
+        return weigh(count_matrix(activities, self.vocab), self.idf)
+
+    def position(self, _id):
+        # the activity's candidate column, or -1 if it isn't a candidate
+        key = np.array(_id.binary, dtype='S12')
+        i = int(np.searchsorted(self.candidate_ids, key))
+        return i if i < len(self.candidate_ids) and self.candidate_ids[i] == key else -1
+
+    def neighbours(self, X, own_positions, k):
+        # (candidate columns, scores) of the k best candidates for each row of X,
+        # best first, leaving out each row's own column
+        S = X.dot(self.champions).tocsr()
+        results = []
+        for row, own in enumerate(own_positions):
+            start, end = S.indptr[row], S.indptr[row + 1]
+            cols, scores = S.indices[start:end], S.data[start:end]
+            if own >= 0:
+                mask = cols != own
+                cols, scores = cols[mask], scores[mask]
+            if len(scores) > k:
+                top = np.argpartition(-scores, k)[:k]
+                cols, scores = cols[top], scores[top]
+            order = np.argsort(-scores, kind='stable')
+            results.append((cols[order], scores[order]))
+        return results
+
+    def save(self, path):
+        terms = [None] * len(self.vocab)
+        for term, col in self.vocab.items():
+            terms[col] = term
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # written aside and renamed, so a process loading it never sees half a file
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, terms=np.array(terms, dtype=str), idf=self.idf, data=self.champions.data,
+                     indices=self.champions.indices, indptr=self.champions.indptr,
+                     shape=np.array(self.champions.shape), candidate_ids=self.candidate_ids)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            vocab = {term: col for col, term in enumerate(f['terms'].tolist())}
+            champions = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+            return cls(vocab, f['idf'], champions, f['candidate_ids'])
+
+
+def related_entry(_id, activity, score):
+    return {'_id': _id, 'activity_name': activity.get('activity_name'), 'category': activity.get('category'),
+            'score': round(float(score), 4)}
+
+
+def compute(activities, champions=CHAMPIONS, top_k=TOP_K, block_rows=BLOCK_ROWS):
+    # yields (model, None) once, then (activity _id, related entries) for every
+    # activity; activities must come in _id order
+    ids, names, public = [], [], []
+
+    def collect():
+        for activity in activities:
+            ids.append(activity['_id'])
+            names.append((activity.get('activity_name'), activity.get('category')))
+            public.append(activity.get('share_status') == 'Public')
+            yield activity
+
+    vocab = {}
+    counts = count_matrix(collect(), vocab, grow=True)
+    model, X, public_rows = Model.build(counts, vocab, ids, np.array(public, dtype=bool), champions)
+    yield model, None
+    positions = np.full(len(ids), -1)
+    positions[public_rows] = np.arange(len(public_rows))
+    for start in range(0, len(ids), block_rows):
+        end = min(start + block_rows, len(ids))
+        for offset, (cols, scores) in enumerate(model.neighbours(X[start:end], positions[start:end], top_k)):
+            entries = []
+            for col, score in zip(cols, scores):
+                row = public_rows[col]
+                name, category = names[row]
+                entries.append(related_entry(ids[row], {'activity_name': name, 'category': category}, score))
+            yield ids[start + offset], entries
+
+
+def rebuild(bucketList, related, path=MODEL_PATH, champions=CHAMPIONS, top_k=TOP_K, progress=True):
+    started = datetime.datetime.now()
+    timer = time.perf_counter()
+    cursor = bucketList.find({}, {field: 1 for field in FIELDS}, batch_size=5000).sort('_id', pymongo.ASCENDING)
+    results = compute(cursor, champions, top_k)
+    model, _ = next(results)
+    model.save(path)
+    written = 0
+    batch = []
+    for _id, entries in results:
+        batch.append(ReplaceOne({'_id': _id}, {'related': entries, 'date_modified': started}, upsert=True))
+        if len(batch) == 1000:
+            related.bulk_write(batch, ordered=False)
+            written += len(batch)
+            batch = []
+            if progress:
+                sys.stderr.write('\rrelated: %d activities (%.0f/sec)' % (written, written / (time.perf_counter() - timer)))
+                sys.stderr.flush()
+    if batch:
+        related.bulk_write(batch, ordered=False)
+        written += len(batch)
+    # lists of activities deleted since the last rebuild
+    related.delete_many({'date_modified': {'$lt': started}})
+    if progress:
+        sys.stderr.write('\n')
+    return written
+
+
+class RelatedIndex:
+    # keeps the stored lists current as activities are saved, using the model from
+    # the last rebuild; activities added since then are not candidates for new
+    # lists, but are added to the lists of the activities they are related to
+    def __init__(self, bucketList, related, path=MODEL_PATH, top_k=TOP_K):
+        self.bucketList = bucketList
+        self.related = related
+        self.path = path
+        self.top_k = top_k
+        self._model = None
+        self._mtime = None
+        self._loading = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        # loads the model file if a rebuild has replaced it; called at startup, and in
+        # the background after that so no request waits for it
+        if not available():
+            return False
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        model = Model.load(self.path)
+        with self._lock:
+            self._model, self._mtime = model, mtime
+        return True
+
+    def model(self):
+        # the model loaded last, or None before the first load; a newer file is
+        # loaded in the background and used from the next save on
+        if not available():
+            return None
+        try:
+            stale = os.path.getmtime(self.path) != self._mtime
+        except OSError:
+            stale = False
+        with self._lock:
+            if stale and not self._loading:
+                self._loading = True
+                threading.Thread(target=self.load_in_background, name='related-load', daemon=True).start()
+            return self._model
+
+    def load_in_background(self):
+        try:
+            self.load()
+        except Exception:
+            log.exception('Could not load the related activities model.')
+        finally:
+            self._loading = False
+
+    def neighbours(self, model, activity):
+        # more than top_k are scored, since some may have been deleted or made private since the rebuild
+        cols, scores = model.neighbours(model.vectors([activity]), [model.position(activity['_id'])],
+                                        self.top_k * 2)[0]
+        ids = [ObjectId(as_bytes(model.candidate_ids[col])) for col in cols]
+        docs = {doc['_id']: doc for doc in self.bucketList.find({'_id': {'$in': ids}, 'share_status': 'Public'},
+                                                               {'activity_name': 1, 'category': 1})}
+        return [related_entry(_id, docs[_id], score) for _id, score in zip(ids, scores) if _id in docs][:self.top_k]
+
+    def apply_change(self, before=None, after=None):
+        # before/after as for stats.apply_change
+        if before and after and all(before.get(field) == after.get(field) for field in FIELDS):
+            return
+        _id = (after or before)['_id']
+        now = datetime.datetime.now()
+        # date_modified feeds the print page's ETag, so every list changed here sets it
+        self.related.update_many({'related._id': _id},
+                                 {'$pull': {'related': {'_id': _id}}, '$set': {'date_modified': now}})
+        if not after:
+            self.related.delete_one({'_id': _id})
+            return
+        model = self.model()
+        if model is None:
+            return
+        entries = self.neighbours(model, after)
+        self.related.replace_one({'_id': _id}, {'related': entries, 'date_modified': now}, upsert=True)
+        if after.get('share_status') == 'Public' and entries:
+            # relatedness is symmetric, so this activity may now belong in its neighbours' lists
+            self.related.bulk_write([
+                UpdateOne({'_id': entry['_id']},
+                          {'$push': {'related': {'$each': [related_entry(_id, after, entry['score'])],
+                                                 '$sort': {'score': -1}, '$slice': self.top_k}},
+                           '$set': {'date_modified': now}})
+                for entry in entries], ordered=False)
+
+    def apply_changes(self, changes):
+        for before, after in changes:
+            self.apply_change(before, after)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Related activities')
+    parser.add_argument('command', choices=['rebuild'], help='rebuild: recompute every related list and the model')
+    parser.add_argument('--top-k', type=int, default=TOP_K)
+    parser.add_argument('--champions', type=int, default=CHAMPIONS, help='candidates kept per term')
+    parser.add_argument('--model', default=MODEL_PATH, help='where to save the model (default RELATED_MODEL_PATH)')
+    args = parser.parse_args()
+    if not available():
+        sys.exit('related.py needs numpy and scipy: pip install numpy scipy')
+
+    db = pymongo.MongoClient(os.getenv('MONGO'))[os.getenv('MONGO_DB', 'bucket_list')]
+    started = time.perf_counter()
+    count = rebuild(db['bucketList'], db['related'], args.model, args.champions, args.top_k)
+    print('Related activities rebuilt for %d activities in %.1fs.' % (count, time.perf_counter() - started))
+
+
+if __name__ == '__main__':
+    main()
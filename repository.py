@@ -0,0 +1,193 @@
+import datetime
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING, ReturnDocument
+from pagination import keyset_query, keyset_result, page_size
+from search import ResultPage, page_number, text_query, tokenize
+from rows import ActivityRow, NearbyRow, UserRow
+from normalize import filter_args, range_filters
+from geocode import near_pipeline, radius_km
+from stats import SUMMARY_FIELDS
+
+PUBLIC = {'share_status': 'Public'}
+ROW_BATCH = 500
+UPCOMING_LIMIT = 5
+
+
+def object_id(value):
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return None
+
+
+def form_version(value):
+    # the version an edit form was rendered from, or None if the form didn't send one
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def update_fields(collection, _id, changes, version=None, return_document=ReturnDocument.AFTER):
+    # $set only the given fields in one round trip. With a version, the write only
+    # applies if nobody else has saved the document since, otherwise None comes back;
+    # None also means there is no such document, which exists() tells apart
+    query = {'_id': _id}
+    if version is not None:
+        # documents written before versioning have no version field
+        query['version'] = version if version else {'$in': [None, 0]}
+    changes = dict(changes, date_modified=datetime.datetime.now())
+    return collection.find_one_and_update(query, {'$set': changes, '$inc': {'version': 1}},
+                                          return_document=return_document)
+
+
+def exists(collection, _id):
+    return collection.count_documents({'_id': _id}, limit=1) > 0
+
+
+class Repository:
+    # blocking data access on pymongo, used by the Flask routes
+    def __init__(self, db, public_read_preference=None):
+        self.db = db
+        self.users = db['users']
+        self.roles = db['roles']
+        self.categories = db['categories']
+        self.bucketList = db['bucketList']
+        self.status = db['status']
+        self.related = db['related']
+        # the public listing, search and near pages may read from secondaries
+        self.public = self.bucketList
+        if public_read_preference:
+            self.public = self.bucketList.with_options(read_preference=public_read_preference)
+
+    def get_user(self, username):
+        return self.users.find_one({'username': username})
+
+    def get_activity(self, activity_id):
+        _id = object_id(activity_id)
+        if _id is None:
+            return None
+        return self.bucketList.find_one({'_id': _id})
+
+    def related_activities(self, activity_id):
+        # the list related.py stored for the activity, or None if it has none yet
+        return self.related.find_one({'_id': activity_id})
+
+    def activity_page(self, query, after=None, before=None, per_page=None, row_type=ActivityRow, args=None,
+                      collection=None):
+        per_page = page_size(per_page)
+        query, sort, after, before = keyset_query(query, after, before)
+        docs = (collection or self.bucketList).find(query, row_type.projection()).sort(sort).limit(per_page + 1)
+        return keyset_result(row_type.from_docs(docs), per_page, after, before, args)
+
+    def public_activities(self, after=None, before=None, per_page=None, filters=None):
+        # filters are the request args; see normalize.range_filters
+        filters = filters or {}
+        query = dict(PUBLIC, **range_filters(filters))
+        return self.activity_page(query, after, before, per_page, args=filter_args(filters), collection=self.public)
+
+    def user_activities(self, username, after=None, before=None, per_page=None):
+        return self.activity_page({'username': username}, after, before, per_page)
+
+    def upcoming_activities(self, username, limit=UPCOMING_LIMIT, today=None):
+        # the count and the first few, both answered from the username_expected_date index
+        today = today or datetime.datetime.combine(datetime.date.today(), datetime.time())
+        query = {'username': username, 'expected_date': {'$gte': today}}
+        rows = ActivityRow.from_docs(self.bucketList.find(query, ActivityRow.projection())
+                                     .sort('expected_date', ASCENDING).limit(limit))
+        return self.bucketList.count_documents(query), rows
+
+    def user_summary(self, username):
+        # read fresh rather than from the load_user cache, since every activity write changes it
+        user = self.users.find_one({'username': username}, {'summary': 1}) or {}
+        return dict(dict.fromkeys(SUMMARY_FIELDS, 0), **user.get('summary', {}))
+
+    def nearby_activities(self, location, radius=None, page=None, per_page=None, args=None, row_type=NearbyRow):
+        # ordered by distance, so paged by number like search results
+        per_page = page_size(per_page)
+        number = page_number(page)
+        pipeline = near_pipeline(location, radius_km(radius), (number - 1) * per_page, per_page + 1,
+                                 row_type.projection())
+        rows = row_type.from_docs(self.public.aggregate(pipeline))
+        return ResultPage(rows[:per_page], per_page, number, len(rows) > per_page, args or {})
+
+    # the full listings are read lazily, batch by batch, as the page renders
+    def activity_rows(self, query=None):
+        return ActivityRow.iter_docs(self.bucketList.find(query or {}, ActivityRow.projection(), batch_size=ROW_BATCH))
+
+    def user_rows(self):
+        return UserRow.iter_docs(self.users.find({}, UserRow.projection(), batch_size=ROW_BATCH))
+
+    def search_activities(self, search_string, page=None, per_page=None, row_type=ActivityRow):
+        per_page = page_size(per_page)
+        number = page_number(page)
+        tokens = tokenize(search_string)
+        args = {'q': search_string}
+        if not tokens:
+            return ResultPage([], per_page, 1, False, args)
+        query, projection, sort = text_query(tokens, row_type.projection())
+        cursor = self.public.find(query, projection).sort(sort)
+        rows = row_type.from_docs(cursor.skip((number - 1) * per_page).limit(per_page + 1))
+        return ResultPage(rows[:per_page], per_page, number, len(rows) > per_page, args)
+
+
+class AsyncRepository:
+    # the same reads on motor, so an ASGI server can run many of them per process
+    def __init__(self, db, public_read_preference=None):
+        self.db = db
+        self.users = db['users']
+        self.roles = db['roles']
+        self.categories = db['categories']
+        self.bucketList = db['bucketList']
+        self.status = db['status']
+        self.related = db['related']
+        self.public = self.bucketList
+        self.public_counters = db['counters']
+        if public_read_preference:
+            self.public = self.bucketList.with_options(read_preference=public_read_preference)
+            self.public_counters = self.public_counters.with_options(read_preference=public_read_preference)
+
+    async def get_user(self, username):
+        return await self.users.find_one({'username': username})
+
+    async def get_activity(self, activity_id):
+        _id = object_id(activity_id)
+        if _id is None:
+            return None
+        return await self.bucketList.find_one({'_id': _id})
+
+    async def collection_version(self, name):
+        # as conditional.collection_version, read the way the public pages are
+        counter = await self.public_counters.find_one({'_id': name}) or {}
+        return counter.get('version', 0), counter.get('date_modified')
+
+    async def related_activities(self, activity_id):
+        return await self.related.find_one({'_id': activity_id})
+
+    async def activity_page(self, query, after=None, before=None, per_page=None, row_type=ActivityRow, args=None,
+                            collection=None):
+        per_page = page_size(per_page)
+        query, sort, after, before = keyset_query(query, after, before)
+        cursor = (collection or self.bucketList).find(query, row_type.projection()).sort(sort).limit(per_page + 1)
+        docs = await cursor.to_list(per_page + 1)
+        return keyset_result(row_type.from_docs(docs), per_page, after, before, args)
+
+    async def public_activities(self, after=None, before=None, per_page=None, filters=None):
+        filters = filters or {}
+        query = dict(PUBLIC, **range_filters(filters))
+        return await self.activity_page(query, after, before, per_page, args=filter_args(filters),
+                                        collection=self.public)
+
+    async def search_activities(self, search_string, page=None, per_page=None, row_type=ActivityRow):
+        per_page = page_size(per_page)
+        number = page_number(page)
+        tokens = tokenize(search_string)
+        args = {'q': search_string}
+        if not tokens:
+            return ResultPage([], per_page, 1, False, args)
+        query, projection, sort = text_query(tokens, row_type.projection())
+        cursor = self.public.find(query, projection).sort(sort)
+        docs = await cursor.skip((number - 1) * per_page).limit(per_page + 1).to_list(per_page + 1)
+        rows = row_type.from_docs(docs)
+        return ResultPage(rows[:per_page], per_page, number, len(rows) > per_page, args)
@@ -0,0 +1,58 @@
+# Compact read-only records for the list pages. Each list view asks Mongo for only
+# the fields its table shows and hands the template these instead of full documents.
+
+
+class Row:
+    __slots__ = ()
+
+    @classmethod
+    def projection(cls):
+        return {field: 1 for field in cls.__slots__}
+
+    @classmethod
+    def from_doc(cls, doc):
+        row = cls.__new__(cls)
+        for field in cls.__slots__:
+            object.__setattr__(row, field, doc.get(field))
+        return row
+
+    @classmethod
+    def from_docs(cls, docs):
+        return [cls.from_doc(doc) for doc in docs]
+
+    @classmethod
+    def iter_docs(cls, docs):
+        # one row at a time, for pages that stream as the cursor is read
+        for doc in docs:
+            yield cls.from_doc(doc)
+
+    def __getitem__(self, field):
+        # templates index rows the same way they index documents
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def __setattr__(self, field, value):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join('%s=%r' % (field, getattr(self, field)) for field in self.__slots__))
+
+
+class ActivityRow(Row):
+    __slots__ = ('_id', 'activity_name', 'category', 'username', 'share_status', 'estimated_cost', 'expected_date',
+                 'date_added')
+
+
+class NearbyRow(Row):
+    # distance is in metres, added by $geoNear
+    __slots__ = ('_id', 'activity_name', 'category', 'username', 'city', 'state', 'country', 'distance')
+
+
+class UserRow(Row):
+    __slots__ = ('_id', 'first_name', 'last_name', 'username', 'email', 'role', 'date_added', 'date_modified')
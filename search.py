@@ -0,0 +1,71 @@
+import re
+import pymongo
+from pagination import Page
+
+TEXT_INDEX_NAME = 'activity_text'
+
+# relative weight of a term match in each field when ranking results
+TEXT_WEIGHTS = {
+    'activity_name': 10,
+    'category': 5,
+    'city': 3,
+    'state': 2,
+    'country': 2,
+    'description': 1,
+}
+
+MAX_TERMS = 10
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def text_index():
+    return pymongo.IndexModel([(field, pymongo.TEXT) for field in TEXT_WEIGHTS],
+                              weights=TEXT_WEIGHTS,
+                              default_language='english',
+                              name=TEXT_INDEX_NAME)
+
+
+def ensure_text_index(collection):
+    collection.create_indexes([text_index()])
+
+
+def tokenize(search_string):
+    # case fold and split on anything that isn't a word character, dropping duplicates
+    tokens = []
+    for token in TOKEN_RE.findall((search_string or '').casefold()):
+        if token not in tokens:
+            tokens.append(token)
+    return tokens[:MAX_TERMS]
+
+
+class ResultPage(Page):
+    # search results are ranked by score so they are paged by number instead of by cursor
+    def __init__(self, rows, per_page, number, has_next, args):
+        super().__init__(rows, per_page,
+                         next_cursor=number + 1 if has_next else None,
+                         prev_cursor=number - 1 if number > 1 else None,
+                         args=args)
+        self.number = number
+
+    def next_args(self):
+        return dict(self.args, page=self.next_cursor, per_page=self.per_page)
+
+    def prev_args(self):
+        return dict(self.args, page=self.prev_cursor, per_page=self.per_page)
+
+
+def page_number(value):
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return 1
+
+
+def text_query(tokens, projection=None):
+    # returns the query, projection and sort for a ranked search of public activities
+    projection = dict(projection or {})
+    projection['score'] = {'$meta': 'textScore'}
+    query = {'$text': {'$search': ' '.join(tokens)}, 'share_status': 'Public'}
+    sort = [('score', {'$meta': 'textScore'}), ('date_added', -1)]
+    return query, projection, sort
+
@@ -0,0 +1,160 @@
+import argparse
+import os
+import pymongo
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+from dotenv import load_dotenv
+from normalize import parse_cost_cents
+
+## necessary for python-dotenv ##
+APP_ROOT = os.path.join(os.path.dirname(__file__), '..')   # refers to application_top
+dotenv_path = os.path.join(APP_ROOT, '.env')
+load_dotenv(dotenv_path)
+
+# Rollups of bucketList kept in the stats collection, one document per
+# (dimension, key): activity count, public activity count and estimated cost in cents.
+# Activity writes apply increments as they happen; rebuild() recomputes everything
+# from bucketList to repair any drift.
+
+DIMENSIONS = ('category', 'country', 'username', 'share_status')
+# the activity fields the rollups are computed from
+FIELDS = DIMENSIONS + ('estimated_cost',)
+
+def contributions(activity, sign):
+    public = 1 if activity.get('share_status') == 'Public' else 0
+    # estimated_cost is already cents once normalized; unparseable costs count as 0
+    cost = parse_cost_cents(activity.get('estimated_cost')) or 0
+    for dimension in DIMENSIONS:
+        key = activity.get(dimension) or ''
+        yield (dimension, key), {'count': sign, 'public_count': sign * public, 'cost_cents': sign * cost}
+
+
+def stat_id(dimension, key):
+    return '%s:%s' % (dimension, key)
+
+
+def apply_change(stats, before=None, after=None):
+    # before/after are the activity as it was and as it is now; None for an insert or delete
+    apply_changes(stats, [(before, after)])
+
+
+def apply_changes(stats, changes):
+    # any number of (before, after) pairs in one bulk_write
+    increments = {}
+    for before, after in changes:
+        for activity, sign in ((before, -1), (after, 1)):
+            if activity:
+                for group, inc in contributions(activity, sign):
+                    totals = increments.setdefault(group, {'count': 0, 'public_count': 0, 'cost_cents': 0})
+                    for field, value in inc.items():
+                        totals[field] += value
+
+    operations = []
+    for (dimension, key), inc in increments.items():
+        inc = {field: value for field, value in inc.items() if value}
+        if inc:
+            operations.append(UpdateOne({'_id': stat_id(dimension, key)},
+                                        {'$inc': inc, '$set': {'dimension': dimension, 'key': key}},
+                                        upsert=True))
+    if operations:
+        stats.bulk_write(operations, ordered=False)
+
+
+def write_batches(collection, operations, batch_size=1000):
+    for start in range(0, len(operations), batch_size):
+        collection.bulk_write(operations[start:start + batch_size], ordered=False)
+
+
+def rebuild(bucketList, stats):
+    # rows are replaced in place rather than dropped and reinserted, since activity
+    # writes keep upserting them meanwhile. Rows that no longer have any activities
+    # are deleted only if they still hold what was read before the scan, so a row a
+    # write created or changed since is kept
+    existing = list(stats.find({}, {'count': 1, 'public_count': 1, 'cost_cents': 1}))
+    totals = {}
+    for activity in bucketList.find({}, {field: 1 for field in FIELDS}, batch_size=5000):
+        for group, inc in contributions(activity, 1):
+            row = totals.setdefault(group, {'count': 0, 'public_count': 0, 'cost_cents': 0})
+            for field, value in inc.items():
+                row[field] += value
+
+    written = set()
+    operations = []
+    for (dimension, key), row in totals.items():
+        _id = stat_id(dimension, key)
+        written.add(_id)
+        operations.append(ReplaceOne({'_id': _id}, dict(row, dimension=dimension, key=key), upsert=True))
+    write_batches(stats, operations)
+    write_batches(stats, [DeleteOne(doc) for doc in existing if doc['_id'] not in written])
+    return len(operations)
+
+
+# Each user record also carries a summary of that user's own activities, so My
+# Bucket List can show it without counting them: summary.activities, summary.public
+# and summary.private.
+SUMMARY_FIELDS = ('activities', 'public', 'private')
+
+
+def summary_contribution(activity, sign):
+    public = 1 if activity.get('share_status') == 'Public' else 0
+    return {'activities': sign, 'public': sign * public, 'private': sign * (1 - public)}
+
+
+def apply_user_change(users, before=None, after=None):
+    apply_user_changes(users, [(before, after)])
+
+
+def apply_user_changes(users, changes):
+    increments = {}
+    for before, after in changes:
+        for activity, sign in ((before, -1), (after, 1)):
+            if activity and activity.get('username'):
+                totals = increments.setdefault(activity['username'], dict.fromkeys(SUMMARY_FIELDS, 0))
+                for field, value in summary_contribution(activity, sign).items():
+                    totals[field] += value
+
+    operations = []
+    for username, inc in increments.items():
+        inc = {'summary.' + field: value for field, value in inc.items() if value}
+        if inc:
+            operations.append(UpdateOne({'username': username}, {'$inc': inc}))
+    if operations:
+        users.bulk_write(operations, ordered=False)
+
+
+def rebuild_user_summaries(bucketList, users):
+    # as rebuild: users left without activities are zeroed only if their summary is
+    # still what was read before the scan
+    existing = list(users.find({'summary': {'$exists': True}}, {'username': 1, 'summary': 1}))
+    totals = {}
+    for activity in bucketList.find({}, {'username': 1, 'share_status': 1}, batch_size=5000):
+        if activity.get('username'):
+            row = totals.setdefault(activity['username'], dict.fromkeys(SUMMARY_FIELDS, 0))
+            for field, value in summary_contribution(activity, 1).items():
+                row[field] += value
+
+    operations = [UpdateOne({'username': username}, {'$set': {'summary': row}}) for username, row in totals.items()]
+    write_batches(users, operations)
+    empty = dict.fromkeys(SUMMARY_FIELDS, 0)
+    write_batches(users, [UpdateOne(doc, {'$set': {'summary': empty}}) for doc in existing
+                          if doc.get('username') not in totals and doc['summary'] != empty])
+    # users created before summaries existed
+    users.update_many({'summary': {'$exists': False}}, {'$set': {'summary': empty}})
+    return len(operations)
+
+
+def top(stats, dimension, limit=25):
+    return list(stats.find({'dimension': dimension, 'count': {'$gt': 0}}).sort('count', pymongo.DESCENDING).limit(limit))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bucket list statistics')
+    parser.add_argument('command', choices=['rebuild'], help='rebuild: recompute every rollup and user summary from bucketList')
+    parser.parse_args()
+
+    db = pymongo.MongoClient(os.getenv('MONGO'))[os.getenv('MONGO_DB', 'bucket_list')]
+    print('Rebuilt %d statistics.' % rebuild(db['bucketList'], db['stats']))
+    print('Rebuilt the summaries of %d users.' % rebuild_user_summaries(db['bucketList'], db['users']))
+
+
+if __name__ == '__main__':
+    main()
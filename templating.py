@@ -0,0 +1,42 @@
+import os
+from flask import current_app, get_flashed_messages, stream_with_context, Response
+from jinja2 import FileSystemBytecodeCache
+
+# Template rendering helpers for the large list pages, and the on-disk bytecode
+# cache that lets a fresh worker skip compiling templates another worker already
+# compiled.
+
+# template output events buffered into each chunk sent to the client
+STREAM_BUFFER = 100
+
+
+def bytecode_cache(directory=None):
+    # without a directory Jinja uses a private one per user (mode 0700, owner
+    # checked), since any directory it reads bytecode from has to be trusted
+    if not directory:
+        return FileSystemBytecodeCache()
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return FileSystemBytecodeCache(directory)
+
+
+def precompile_templates(env):
+    # loads every template once so compile (or bytecode cache read) happens at
+    # startup instead of on the first request for each page
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+
+def stream_template(template_name, **context):
+    # render_template, but the page is sent in chunks as it renders so the rows of a
+    # long table go out while the cursor is still producing them
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    # the session cookie is written before the body streams, so pending flash
+    # messages have to come out of the session now; the template reads them back
+    # from the request context
+    get_flashed_messages()
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER)
+    return Response(stream_with_context(stream))
@@ -0,0 +1,55 @@
+import pytest
+import bulk
+import stats
+
+mongomock = pytest.importorskip('mongomock')
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient().db
+
+
+def public_activity(db):
+    activity = {'activity_name': 'skydiving', 'category': 'Nature', 'country': 'Peru', 'username': 'someone',
+                'share_status': 'Public', 'estimated_cost': 15000, 'version': 1}
+    db['bucketList'].insert_one(activity)
+    stats.rebuild(db['bucketList'], db['stats'])
+    return activity
+
+
+def test_selected_twice_is_written_and_counted_once(db):
+    activity = public_activity(db)
+    selected = [str(activity['_id']), str(activity['_id']), str(activity['_id']).upper()]
+    result = bulk.set_fields(db['bucketList'], selected, {'share_status': 'Private'}, 'activity_name',
+                             {field: 1 for field in stats.FIELDS})
+    assert result.counts() == {bulk.DONE: 1}
+    assert len(result.changes) == 1
+    stats.apply_changes(db['stats'], result.changes)
+    assert db['stats'].find_one({'_id': 'share_status:Public'})['count'] == 0
+    assert db['stats'].find_one({'_id': 'share_status:Private'})['count'] == 1
+
+
+def test_delete_selected_twice_is_counted_once(db):
+    activity = public_activity(db)
+    result = bulk.delete(db['bucketList'], [str(activity['_id'])] * 2, 'activity_name')
+    assert result.counts() == {bulk.DONE: 1}
+    assert len(result.changes) == 1
+    assert db['bucketList'].count_documents({}) == 0
+
+
+def test_write_lost_to_another_edit_is_not_counted(db):
+    activity = public_activity(db)
+    find = db['bucketList'].find
+
+    def find_then_edit(*args, **kwargs):
+        # someone else saves the activity between the read and the bulk write
+        docs = list(find(*args, **kwargs))
+        db['bucketList'].update_one({'_id': activity['_id']}, {'$set': {'category': 'Event'}, '$inc': {'version': 1}})
+        return docs
+
+    db['bucketList'].find = find_then_edit
+    result = bulk.set_fields(db['bucketList'], [str(activity['_id'])], {'share_status': 'Private'}, 'activity_name')
+    db['bucketList'].find = find
+    assert result.counts() == {bulk.CHANGED: 1}
+    assert result.changes == []